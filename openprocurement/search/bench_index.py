@@ -0,0 +1,627 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import os
+import sys
+import gzip
+import shutil
+import logging
+import argparse
+import resource
+import tempfile
+import urllib2
+import simplejson as json
+from uuid import uuid4
+from random import Random
+from datetime import datetime, timedelta
+from multiprocessing import Process
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+from urlparse import urlparse, parse_qs
+from time import time, sleep
+
+from openprocurement.search.engine import IndexEngine
+from openprocurement.search.source.tender import TenderSource
+from openprocurement.search.source.replay import CorpusFile, CorpusReader, replay_source
+from openprocurement.search.index.tender import TenderIndex
+
+
+LOG_FORMAT = '%(asctime)s %(levelname)s %(processName)s %(message)s'
+
+logger = logging.getLogger('bench_index')
+
+
+class ThreadingServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class JsonHandler(BaseHTTPRequestHandler):
+    """Base handler for both fake API and fake ES servers
+    """
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+    wbufsize = -1
+
+    def log_message(self, format, *args):
+        logger.debug("%s %s", self.server.server_name, format % args)
+
+    def read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            return self.rfile.read(length)
+        return ''
+
+    def send_json(self, data, code=200):
+        body = json.dumps(data)
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json; charset=UTF-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def do_GET(self):
+        self.route()
+
+    def do_HEAD(self):
+        self.route()
+
+    def do_PUT(self):
+        self.route()
+
+    def do_POST(self):
+        self.route()
+
+    def do_DELETE(self):
+        self.route()
+
+
+class FakeAPIHandler(JsonHandler):
+    """Fake openprocurement.api, serves /api/<ver>/<resource> feed and documents
+    """
+    def route(self):
+        url = urlparse(self.path)
+        parts = url.path.strip('/').split('/')
+        if parts[0] == '_bench':
+            return self.send_json(self.server.stats())
+        if len(parts) < 3 or parts[0] != 'api':
+            return self.send_json({'status': 'error'}, 404)
+        if self.server.latency:
+            sleep(self.server.latency)
+        if parts[2] == 'spore':
+            return self.send_json({})
+        if len(parts) == 3:
+            return self.send_feed(url, parse_qs(url.query))
+        doc = self.server.docs.get(parts[3])
+        if not doc:
+            return self.send_json({'status': 'error'}, 404)
+        self.server.stat_docs += 1
+        return self.send_json({'data': doc})
+
+    def send_feed(self, url, params):
+        feed = self.server.feed
+        offset = int(params.get('offset', ['0'])[0] or 0)
+        limit = int(params.get('limit', ['100'])[0] or 100)
+        if params.get('descending', [''])[0]:
+            page = feed[::-1][offset:offset + limit]
+        else:
+            page = feed[offset:offset + limit]
+        next_offset = offset + len(page)
+        self.server.stat_pages += 1
+        return self.send_json({
+            'data': page,
+            'next_page': {
+                'offset': next_offset,
+                'path': '%s?offset=%d' % (url.path, next_offset),
+                'uri': 'http://%s%s?offset=%d' % (self.headers.get('Host'), url.path, next_offset),
+            }
+        })
+
+
+class FakeElasticHandler(JsonHandler):
+    """Lightweight ES 1.7 compatible stub, keeps documents in memory
+    and records bulk payloads
+    """
+    def route(self):
+        url = urlparse(self.path)
+        params = dict((k, v[-1]) for k, v in parse_qs(url.query).items())
+        parts = [p for p in url.path.split('/') if p]
+        body = self.read_body()
+        if self.server.latency:
+            sleep(self.server.latency)
+        if not parts:
+            return self.send_json({
+                'status': 200,
+                'name': 'bench_index',
+                'version': {'number': '1.7.6', 'lucene_version': '4.10.4'},
+            })
+        if parts[0] == '_bench':
+            return self.send_json(self.server.stats())
+        if parts[0] == '_bulk' or parts[-1] == '_bulk':
+            return self.bulk(body)
+        if parts[0] == '_stats' or parts[-1] == '_stats':
+            return self.index_stats(parts[0] if len(parts) > 1 else None)
+        if parts[0] == '_aliases' or len(parts) > 1 and parts[1] == '_alias':
+            return self.send_json({'acknowledged': True})
+        if parts[-1] == '_search':
+            return self.search(parts[0] if len(parts) > 1 else '_all', params, body)
+        if len(parts) == 1:
+            return self.index_op(parts[0], body)
+        if len(parts) == 3:
+            return self.doc_op(parts[0], parts[1], parts[2], params, body)
+        return self.send_json({'error': 'not supported', 'status': 400}, 400)
+
+    def missing(self, name):
+        return self.send_json({'error': 'IndexMissingException[[%s] missing]' % name,
+                               'status': 404}, 404)
+
+    def index_op(self, name, body):
+        indices = self.server.indices
+        if self.command == 'PUT':
+            data = json.loads(body) if body else {}
+            indices[name] = {'mappings': data.get('mappings', {}), 'docs': {}}
+            return self.send_json({'acknowledged': True})
+        if self.command == 'DELETE':
+            indices.pop(name, None)
+            return self.send_json({'acknowledged': True})
+        if name not in indices:
+            return self.missing(name)
+        return self.send_json({name: {
+            'aliases': {},
+            'mappings': indices[name]['mappings'],
+            'settings': {},
+        }})
+
+    def index_stats(self, name):
+        stats = {}
+        for k, v in self.server.indices.items():
+            if name and k != name:
+                continue
+            stats[k] = {'primaries': {'docs': {'count': len(v['docs'])}}}
+        return self.send_json({'indices': stats})
+
+    def put_doc(self, name, doc_type, doc_id, version, source):
+        if name not in self.server.indices:
+            self.server.indices[name] = {'mappings': {}, 'docs': {}}
+        docs = self.server.indices[name]['docs']
+        if doc_id in docs and docs[doc_id][0] >= version:
+            return 409
+        created = doc_id not in docs
+        docs[doc_id] = (version, source)
+        return 201 if created else 200
+
+    def doc_op(self, name, doc_type, doc_id, params, body):
+        if self.command in ('PUT', 'POST'):
+            version = long(params.get('version') or 1)
+            source = json.loads(body)
+            status = self.put_doc(name, doc_type, doc_id, version, source)
+            return self.send_json({'_index': name, '_type': doc_type, '_id': doc_id,
+                                   '_version': version, 'created': status == 201}, status)
+        if name not in self.server.indices:
+            return self.missing(name)
+        found = self.server.indices[name]['docs'].get(doc_id)
+        if not found:
+            return self.send_json({'_index': name, '_type': doc_type, '_id': doc_id,
+                                   'found': False}, 404)
+        res = {'_index': name, '_type': doc_type, '_id': doc_id,
+               '_version': found[0], 'found': True}
+        if params.get('_source', 'true') != 'false':
+            res['_source'] = found[1]
+        return self.send_json(res)
+
+    def bulk(self, body):
+        server = self.server
+        server.stat_bulk_requests += 1
+        server.stat_bulk_bytes += len(body)
+        if server.record_file:
+            server.record_file.write(body)
+            server.record_file.flush()
+        lines = body.splitlines()
+        items = []
+        for n in range(0, len(lines) - 1, 2):
+            action = json.loads(lines[n])
+            op_type, meta = action.items()[0]
+            source = json.loads(lines[n + 1])
+            version = long(meta.get('_version') or 1)
+            status = self.put_doc(meta['_index'], meta['_type'], meta['_id'], version, source)
+            meta['status'] = status
+            meta['_version'] = version
+            items.append({op_type: meta})
+            server.stat_bulk_docs += 1
+        return self.send_json({'took': 1, 'errors': False, 'items': items})
+
+    def search(self, names, params, body):
+        query = json.loads(body) if body else {}
+        start = int(params.get('from') or query.get('from') or 0)
+        size = int(params.get('size') or query.get('size') or 10)
+        hits = list()
+        for name in names.split(','):
+            index = self.server.indices.get(name)
+            if index:
+                hits.extend(v[1] for v in index['docs'].values())
+        hits.sort(key=lambda d: d.get('dateModified'), reverse=True)
+        return self.send_json({
+            'took': 1,
+            'timed_out': False,
+            'hits': {
+                'total': len(hits),
+                'hits': [{'_source': h} for h in hits[start:start + size]],
+            }
+        })
+
+
+class FakeServer(ThreadingServer):
+    server_name = 'server'
+    latency = 0
+    record_file = None
+    stat_pages = 0
+    stat_docs = 0
+    stat_bulk_requests = 0
+    stat_bulk_docs = 0
+    stat_bulk_bytes = 0
+
+    def __init__(self, handler_class, latency=0):
+        ThreadingServer.__init__(self, ('127.0.0.1', 0), handler_class)
+        self.latency = latency
+        self.indices = {}
+
+    @property
+    def address(self):
+        return '%s:%d' % self.server_address
+
+    def stats(self):
+        return {
+            'api_pages': self.stat_pages,
+            'api_docs': self.stat_docs,
+            'bulk_requests': self.stat_bulk_requests,
+            'bulk_docs': self.stat_bulk_docs,
+            'bulk_bytes': self.stat_bulk_bytes,
+        }
+
+    def run(self, record_filename=None):
+        if record_filename:
+            self.record_file = open(record_filename, 'wb')
+        try:
+            self.serve_forever()
+        except KeyboardInterrupt:
+            pass
+
+    def start(self, record_filename=None):
+        """serve in subprocess, so servers don't affect indexer CPU usage"""
+        self.process = Process(target=self.run, args=(record_filename,),
+                               name=self.server_name)
+        self.process.daemon = True
+        self.process.start()
+        self.socket.close()
+
+    def stop(self):
+        if self.process.is_alive():
+            self.process.terminate()
+        self.process.join()
+
+
+def generate_corpus(count, seed=1):
+    """generate synthetic tenders, dateModified ascending"""
+    rand = Random(seed)
+    statuses = ['active.enquiries', 'active.tendering', 'active.auction',
+                'active.qualification', 'complete', 'cancelled', 'unsuccessful']
+    proc_types = ['belowThreshold', 'aboveThresholdUA', 'aboveThresholdEU',
+                  'negotiation', 'reporting']
+    words = [u'послуги', u'ремонт', u'закупівля', u'будівництво', u'поточний',
+             u'капітальний', u'обладнання', u'продукти', u'харчування', u'паливо',
+             u'works', u'services', u'supply', u'office', u'equipment']
+    date = datetime(2018, 1, 1, 9, 0, 0)
+    for n in range(count):
+        date += timedelta(seconds=rand.randint(1, 120), microseconds=rand.randint(0, 999999))
+        cpv = '%08d-%d' % (rand.randint(3000000, 98000000), rand.randint(0, 9))
+        status = rand.choice(statuses)
+        proc_type = rand.choice(proc_types)
+        title = u' '.join(rand.choice(words) for i in range(rand.randint(3, 8)))
+        edrpou = '%08d' % rand.randint(10000, 44000000)
+        items = [{
+            'id': uuid4().hex,
+            'description': u' '.join(rand.choice(words) for i in range(5)),
+            'classification': {'scheme': u'CPV', 'id': cpv, 'description': title},
+            'quantity': rand.randint(1, 1000),
+            'unit': {'code': u'H87', 'name': u'штуки'},
+            'deliveryAddress': {'postalCode': '%05d' % rand.randint(1000, 99999),
+                                'countryName': u'Україна'},
+        } for i in range(rand.randint(1, 5))]
+        tender = {
+            'id': uuid4().hex,
+            'tenderID': 'UA-%s-%06d-a' % (date.strftime('%Y-%m-%d'), n + 1),
+            'date': date.isoformat() + '+02:00',
+            'dateModified': date.isoformat() + '+02:00',
+            'status': status,
+            'procurementMethod': 'open',
+            'procurementMethodType': proc_type,
+            'title': title,
+            'description': title,
+            'value': {'amount': rand.randint(1000, 10000000) / 100.0,
+                      'currency': 'UAH', 'valueAddedTaxIncluded': True},
+            'procuringEntity': {
+                'name': u'Організація %s' % edrpou,
+                'identifier': {'scheme': 'UA-EDR', 'id': edrpou},
+                'address': {'postalCode': '%05d' % rand.randint(1000, 99999)},
+            },
+            'items': items,
+        }
+        if proc_type in ('negotiation', 'reporting') or status == 'complete':
+            tender['awards'] = [{'id': uuid4().hex, 'status': 'active',
+                                 'date': tender['dateModified']}]
+            tender['contracts'] = [{'id': uuid4().hex, 'status': 'active',
+                                    'date': tender['dateModified']}]
+        yield tender
+
+
+def load_corpus(filename):
+    """load tenders from recorded corpus (last versions) or
+    from json-lines file (optionaly gzipped), each line is
+    either tender or {"data": tender}"""
+    with open(filename, 'rb') as fp:
+        magic = fp.read(len(CorpusFile.MAGIC))
+    if magic == CorpusFile.MAGIC:
+        reader = CorpusReader(filename)
+        for doc_id in reader.docs.get('tenders', {}).keys():
+            yield reader.get_doc('tenders', doc_id, '~')['data']
+        return
+    opener = gzip.open if filename.endswith('.gz') else open
+    with opener(filename, 'rb') as fp:
+        for line in fp:
+            if not line.strip():
+                continue
+            doc = json.loads(line)
+            if 'data' in doc and 'id' not in doc:
+                doc = doc['data']
+            yield doc
+
+
+def current_rss():
+    """resident set size in KB"""
+    try:
+        with open('/proc/self/statm') as fp:
+            pages = int(fp.read().split()[1])
+        return pages * resource.getpagesize() / 1024
+    except (IOError, IndexError, ValueError):
+        return 0
+
+
+class Stage(object):
+    """Measure wall time, CPU and RSS for one benchmark stage
+    """
+    def __init__(self, name):
+        self.name = name
+        self.docs = 0
+
+    def __enter__(self):
+        self.start_rss = current_rss()
+        self.start_usage = resource.getrusage(resource.RUSAGE_SELF)
+        self.start_time = time()
+        logger.info("Stage %s started", self.name)
+        return self
+
+    def __exit__(self, *exc_info):
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        self.wall = time() - self.start_time
+        self.user = usage.ru_utime - self.start_usage.ru_utime
+        self.system = usage.ru_stime - self.start_usage.ru_stime
+        self.rss = current_rss()
+        self.rss_delta = self.rss - self.start_rss
+        self.maxrss = usage.ru_maxrss
+        logger.info("Stage %s finished %s", self.name, self.report_line())
+
+    @property
+    def docs_per_sec(self):
+        return self.docs / self.wall if self.wall else 0.0
+
+    def report_line(self):
+        return "%6d docs %8.3f sec %8.1f docs/s cpu %6.2f+%-6.2f rss %d KB (%+d KB)" % (
+            self.docs, self.wall, self.docs_per_sec, self.user, self.system,
+            self.rss, self.rss_delta)
+
+    def as_dict(self):
+        return {
+            'stage': self.name,
+            'docs': self.docs,
+            'wall': round(self.wall, 6),
+            'docs_per_sec': round(self.docs_per_sec, 3),
+            'cpu_user': round(self.user, 3),
+            'cpu_system': round(self.system, 3),
+            'rss_kb': self.rss,
+            'rss_delta_kb': self.rss_delta,
+            'maxrss_kb': self.maxrss,
+        }
+
+
+class IndexBenchmark(object):
+    def __init__(self, args):
+        self.args = args
+        self.stages = []
+        self.workdir = tempfile.mkdtemp(prefix='bench_index_')
+
+    def start_servers(self):
+        if self.args.corpus:
+            docs = list()
+            for filename in self.args.corpus:
+                docs.extend(load_corpus(filename))
+        elif self.args.replay:
+            docs = list(load_corpus(self.args.replay))
+        else:
+            docs = list(generate_corpus(self.args.n, self.args.seed))
+        docs.sort(key=lambda d: d['dateModified'])
+        logger.info("Corpus %d docs", len(docs))
+
+        self.api = FakeServer(FakeAPIHandler, self.args.api_latency / 1000.0)
+        self.api.server_name = 'FakeAPI'
+        self.api.docs = dict((d['id'], d) for d in docs)
+        self.api.feed = [{'id': d['id'], 'dateModified': d['dateModified']} for d in docs]
+        self.api.start()
+
+        self.es = FakeServer(FakeElasticHandler, self.args.es_latency / 1000.0)
+        self.es.server_name = 'FakeElastic'
+        self.es.start(self.args.record_bulk)
+
+        logger.info("Fake API at %s, fake ES at %s", self.api.address, self.es.address)
+        self.corpus_size = len(docs)
+        del docs
+
+    def stop_servers(self):
+        for server in (self.api, self.es):
+            server.stop()
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def stubs_stats(self):
+        stats = dict()
+        for server in (self.api, self.es):
+            fp = urllib2.urlopen('http://%s/_bench' % server.address, timeout=10)
+            stats[server.server_name] = json.loads(fp.read())
+        return stats
+
+    def make_config(self):
+        return {
+            'index_names': os.path.join(self.workdir, 'index_names'),
+            'elastic_host': self.es.address,
+            'elastic_timeout': 30,
+            'bulk_insert': self.args.bulk,
+            'start_wait': 0,
+            'update_wait': 0,
+            'async_reindex': 0,
+            'check_on_start': 0,
+            'index_speed': 1e9,
+            'reindex_loops': 1,
+            'tender_check': '1,0',
+            'tender_api_url': 'http://' + self.api.address,
+            'tender_api_version': '0',
+            'tender_api_mode': '_all_',
+            'tender_limit': self.args.limit,
+            'tender_preload': self.args.preload,
+            'tender_skip_until': None,
+            'tender_skip_after': None,
+            'tender_fast_client': False,
+            'tender_decode_orgs': False,
+            'tender_record': self.args.record or '',
+            'timeout': 30,
+        }
+
+    def make_source(self):
+        if self.args.replay:
+            source_class = replay_source(TenderSource, self.args.replay, self.args.speed)
+            return source_class(self.config)
+        return TenderSource(self.config)
+
+    def stage_feed(self):
+        source = self.make_source()
+        source.reset()
+        self.feed = list()
+        with Stage('feed') as stage:
+            while True:
+                count = len(self.feed)
+                self.feed.extend(source.items())
+                if len(self.feed) == count:
+                    break
+            stage.docs = len(self.feed)
+        self.stages.append(stage)
+
+    def stage_fetch(self):
+        source = self.make_source()
+        source.reset()
+        with Stage('fetch') as stage:
+            for info in self.feed:
+                source.get(info)
+                stage.docs += 1
+        self.stages.append(stage)
+
+    def stage_index(self):
+        source = self.make_source()
+        index = TenderIndex(self.engine, source, self.config)
+        index_name = index.new_index()
+        with Stage('index') as stage:
+            stage.docs = index.index_source(index_name, reset=True, reindex=True) or 0
+        self.stages.append(stage)
+        with Stage('check') as stage:
+            if not index.check_index(index_name):
+                logger.error("Check index %s failed", index_name)
+            index.set_current(index_name)
+            stage.docs = self.engine_docs(index_name)
+        self.stages.append(stage)
+
+    def engine_docs(self, index_name):
+        return self.engine.index_stats(index_name)['docs']['count']
+
+    def run(self):
+        self.start_servers()
+        try:
+            self.config = self.make_config()
+            self.engine = IndexEngine(dict(self.config))
+            self.engine.wait_for_backend()
+            if 'feed' in self.args.stages:
+                self.stage_feed()
+            if 'fetch' in self.args.stages:
+                self.stage_fetch()
+            if 'index' in self.args.stages:
+                self.stage_index()
+            self.stubs = self.stubs_stats()
+        finally:
+            self.stop_servers()
+
+    def report(self):
+        data = {
+            'corpus': self.corpus_size,
+            'api_latency_ms': self.args.api_latency,
+            'es_latency_ms': self.args.es_latency,
+            'bulk_insert': bool(self.args.bulk),
+            'stages': [s.as_dict() for s in self.stages],
+            'stubs': self.stubs,
+        }
+        for stage in self.stages:
+            logger.info("%-6s %s", stage.name, stage.report_line())
+        logger.info("Stubs %s", json.dumps(self.stubs, sort_keys=True))
+        if self.args.o:
+            with open(self.args.o, 'w') as fp:
+                json.dump(data, fp, sort_keys=True, indent=2)
+        return data
+
+
+def main():
+    parser = argparse.ArgumentParser(description='openprocurement.search.bench_index')
+    parser.add_argument('-n', metavar='docs', type=int, default=5000,
+        help='number of generated tenders (ignored with --corpus)')
+    parser.add_argument('-o', metavar='result.json', help='save report as json')
+    parser.add_argument('-v', metavar='verbosity', help='10 = debug, 40 = error',
+        type=int, default=logging.INFO)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--corpus', metavar='tenders.jsonl.gz', nargs='*')
+    parser.add_argument('--bulk', type=int, default=1, help='use bulk_insert (default 1)')
+    parser.add_argument('--limit', type=int, default=1000, help='feed page size')
+    parser.add_argument('--preload', type=int, default=10000)
+    parser.add_argument('--api-latency', type=float, default=0, help='fake API latency ms')
+    parser.add_argument('--es-latency', type=float, default=0, help='fake ES latency ms')
+    parser.add_argument('--replay', metavar='tenders.corpus',
+        help='replay recorded feed and documents instead of fake API')
+    parser.add_argument('--record', metavar='tenders.corpus',
+        help='record fake API feed and documents for later --replay')
+    parser.add_argument('--speed', type=float, default=0,
+        help='replay speed, 1 = recorded timing, 0 = no delays (default 0)')
+    parser.add_argument('--record-bulk', metavar='bulk.ndjson', help='save bulk payloads')
+    parser.add_argument('--stages', default='feed,fetch,index',
+        help='comma separated list of stages (default feed,fetch,index)')
+    args = parser.parse_args()
+    args.stages = args.stages.split(',')
+
+    logging.basicConfig(level=args.v, format=LOG_FORMAT)
+    if args.v > logging.DEBUG:
+        for name in ('elasticsearch', 'openprocurement.search', 'restkit'):
+            logging.getLogger(name).setLevel(logging.WARNING)
+
+    bench = IndexBenchmark(args)
+    try:
+        bench.run()
+    except KeyboardInterrupt:
+        logger.info("User interrupt")
+        return 1
+    bench.report()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
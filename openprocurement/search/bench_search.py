@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""Microbenchmarks for search_server query building and response shaping
+
+Usage: bench_search search.ini [-o result.json] [--compare baseline.json]
+
+Config is only needed to import search_server, Elasticsearch is not used.
+Reference results are kept in docs/bench/search_server.json, rerun with
+--compare after changing search_server and update the file in the same
+commit if numbers move.
+"""
+import sys
+import gc
+import argparse
+import logging
+import platform
+import simplejson as json
+from random import Random
+from timeit import default_timer
+from uuid import uuid4
+
+from openprocurement.search.bench_index import generate_corpus
+from openprocurement.search.engine import RawItems
+
+logger = logging.getLogger('bench_search')
+LOG_FORMAT = '%(asctime)-15s %(levelname)s %(message)s'
+
+# representative request arguments, keys are case names
+SEARCH_ARGS = {
+    'empty': [],
+    'query': [('query', u'ремонт доріг')],
+    'query_sort': [('query', u'ремонт'), ('sort', 'value'), ('order', 'asc')],
+    'cpv_like': [('cpv_like', '4523')],
+    'cpv_like_multi': [('cpv_like', '4523'), ('cpv_like', '3319'), ('cpv_like', '0911')],
+    'edrpou_status': [('edrpou', '01234567'), ('status', 'active.tendering'),
+                      ('status', 'active.enquiries')],
+    'region_value': [('region', '01-09'), ('value', '10000-500000')],
+    'dates': [('tender_start', '2018-01-01'), ('tender_end', '2018-02-01'),
+              ('datemod_start', '2018-01-15')],
+    'mixed': [('query', u'послуги'), ('cpv_like', '45'), ('region', '01-09'),
+              ('proc_type', 'aboveThresholdUA'), ('status', 'active.tendering'),
+              ('value', '10000-500000'), ('date_start', '2018-01-01'),
+              ('date_end', '2018-06-01'), ('sort', 'date')],
+}
+
+
+def generate_auctions(count, items, seed=1):
+    """generate auctions with items for auctions.map response"""
+    rand = Random(seed)
+    for n in range(count):
+        yield {
+            'id': uuid4().hex,
+            'auctionID': 'UA-EA-2018-01-01-%06d' % n,
+            'title': u'Лот %d нерухомість' % n,
+            'description': u'Опис лоту %d' % n,
+            'auctionPeriod': {'startDate': '2018-01-01T10:00:00+02:00'},
+            'procuringEntity': {'name': u'Банк %d' % rand.randint(1, 50)},
+            'value': {'amount': rand.randint(1000, 1000000), 'currency': 'UAH'},
+            'items': [{
+                'id': uuid4().hex,
+                'description': u'Приміщення %d' % i if rand.random() > 0.3 else '',
+                'address': {'postalCode': '%05d' % rand.randint(1000, 99999),
+                            'locality': u'Київ'},
+                'location': {'latitude': '50.%d' % rand.randint(0, 9999),
+                             'longitude': '30.%d' % rand.randint(0, 9999)},
+            } for i in range(items)],
+        }
+
+
+class SearchBenchmark(object):
+    def __init__(self, args):
+        self.args = args
+        self.results = dict()
+
+    def setup(self):
+        from werkzeug.datastructures import ImmutableMultiDict
+        from openprocurement.search import search_server as server
+        self.server = server
+        self.search_args = dict((k, ImmutableMultiDict(v)) for k, v in SEARCH_ARGS.items())
+        self.tenders = {
+            'items': list(generate_corpus(100, self.args.seed)),
+            'total': 123456,
+            'start': 0,
+        }
+        self.auctions = list(generate_auctions(1000, 3, self.args.seed))
+        self.short_auctions = [{'id': a['id'], 'items': [{'id': i['id']} for i in a['items']]}
+                               for a in self.auctions]
+
+    def cases(self):
+        server = self.server
+        for name, args in sorted(self.search_args.items()):
+            yield ('prepare_search_body.' + name,
+                   lambda args=args: server.prepare_search_body(args, default_sort='date'))
+        yield ('prefix_query', lambda: server.prefix_query(['45', '33', '09'],
+               'items.classification.id', force_lower=True))
+        yield ('range_query.float', lambda: server.range_query(['100-5000', '10000'],
+               'value.amount', force_float=True))
+        yield ('range_query.str', lambda: server.range_query(['01-09', '65'],
+               'procuringEntity.address.postalCode'))
+
+        def append_dates():
+            body = [{'match': {'status': {'query': 'active'}}}]
+            server.append_dates_query(body, '2018-01-01', server.dates_map['tender_start'])
+            server.append_dates_query(body, '2018-02-01', server.dates_map['tender_end'])
+            server.append_dates_query(body, '2018-01-15', server.dates_map['datemod_start'])
+            return body
+        yield ('append_dates_query', append_dates)
+
+        yield ('convert_auction_map_items.full',
+               lambda: server.convert_auction_map_items(self.auctions))
+        yield ('convert_auction_map_items.short',
+               lambda: server.convert_auction_map_items(self.short_auctions, short=True))
+
+        map_response = {'items': server.convert_auction_map_items(self.auctions),
+                        'total': 5000, 'start': 0, 'count': 1000}
+        yield ('jsonify.tenders_100', lambda: server.jsonify(self.tenders))
+        raw_items = [json.dumps(d, separators=(',', ':')) for d in self.tenders['items']]
+        raw_tenders = dict(self.tenders, items=RawItems('[' + ','.join(raw_items) + ']',
+                                                        raw_items[0]))
+        yield ('jsonify.tenders_100_raw', lambda: server.jsonify(raw_tenders))
+        yield ('jsonify.auctions_map_3000', lambda: server.jsonify(map_response))
+
+    def measure(self, func):
+        """returns list of per call times (sec), one for each repeat"""
+        number = 1
+        while True:
+            start = default_timer()
+            for i in xrange(number):
+                func()
+            elapsed = default_timer() - start
+            if elapsed >= self.args.min_time or number >= 10 ** 7:
+                break
+            number *= 2 if elapsed > self.args.min_time / 10 else 10
+        timings = [elapsed / number]
+        for r in range(self.args.repeat - 1):
+            start = default_timer()
+            for i in xrange(number):
+                func()
+            timings.append((default_timer() - start) / number)
+        return number, timings
+
+    def run(self):
+        self.setup()
+        only = self.args.only
+        gc_enabled = gc.isenabled()
+        with self.server.search_server.app_context():
+            for name, func in self.cases():
+                if only and not any(name.startswith(o) for o in only):
+                    continue
+                gc.collect()
+                gc.disable()
+                try:
+                    number, timings = self.measure(func)
+                finally:
+                    if gc_enabled:
+                        gc.enable()
+                timings.sort()
+                self.results[name] = {
+                    'loops': number,
+                    'best_us': round(timings[0] * 1e6, 3),
+                    'median_us': round(timings[len(timings) // 2] * 1e6, 3),
+                }
+                logger.info("%-44s %10.2f us (median %10.2f us, %d loops)", name,
+                    timings[0] * 1e6, timings[len(timings) // 2] * 1e6, number)
+
+    def report(self):
+        data = {
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'repeat': self.args.repeat,
+            'results': self.results,
+        }
+        if self.args.o:
+            with open(self.args.o, 'w') as fp:
+                json.dump(data, fp, sort_keys=True, indent=2)
+        return data
+
+    def compare(self, filename):
+        """returns number of cases slower than baseline by more than tolerance"""
+        with open(filename) as fp:
+            baseline = json.load(fp)['results']
+        regressions = 0
+        for name in sorted(self.results):
+            if name not in baseline:
+                continue
+            base = baseline[name]['best_us']
+            curr = self.results[name]['best_us']
+            ratio = curr / base if base else 0
+            mark = ''
+            if ratio > 1 + self.args.tolerance / 100.0:
+                mark = 'SLOWER'
+                regressions += 1
+            elif ratio and ratio < 1 - self.args.tolerance / 100.0:
+                mark = 'faster'
+            logger.info("%-44s %10.2f -> %10.2f us %6.2fx %s", name, base, curr, ratio, mark)
+        return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='openprocurement.search.bench_search')
+    parser.add_argument('config', metavar='search.ini')
+    parser.add_argument('-o', metavar='result.json', help='save results as json')
+    parser.add_argument('-v', metavar='verbosity', help='10 = debug, 40 = error',
+        type=int, default=logging.INFO)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--min-time', type=float, default=0.2,
+        help='minimal time of one repeat in seconds (default 0.2)')
+    parser.add_argument('--only', nargs='*', metavar='case',
+        help='run only cases which names start with')
+    parser.add_argument('--compare', metavar='baseline.json',
+        help='compare with previous results, exit 1 on regression')
+    parser.add_argument('--tolerance', type=float, default=20,
+        help='allowed slowdown in percent for --compare (default 20)')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=args.v, format=LOG_FORMAT)
+
+    bench = SearchBenchmark(args)
+    bench.run()
+    bench.report()
+    if args.compare and bench.compare(args.compare):
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
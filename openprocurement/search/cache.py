@@ -0,0 +1,270 @@
+# -*- coding: utf-8 -*-
+import os
+import mmap
+import zlib
+import fcntl
+import struct
+import hashlib
+from collections import OrderedDict
+from threading import Lock
+from time import time
+
+
+class SearchCache(object):
+    """In-process LRU cache of serialized search responses
+
+    Entries expire after `ttl` seconds, the cache holds at most
+    `max_items` entries and `max_bytes` of keys and values together,
+    least recently used entries are evicted first.
+    """
+    def __init__(self, ttl=60, max_bytes=64 << 20, max_items=10000):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.max_items = max_items
+        self.entries = OrderedDict()
+        self.lock = Lock()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return None
+            if entry[0] < time():
+                self.size -= len(key) + len(entry[1])
+                self.misses += 1
+                return None
+            self.entries[key] = entry
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value):
+        entry_size = len(key) + len(value)
+        if entry_size > self.max_bytes / 8:
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= len(key) + len(old[1])
+            self.entries[key] = (time() + self.ttl, value)
+            self.size += entry_size
+            while self.entries and (self.size > self.max_bytes or
+                                    len(self.entries) > self.max_items):
+                old_key, old = self.entries.popitem(last=False)
+                self.size -= len(old_key) + len(old[1])
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def stats(self):
+        return {
+            'items': len(self.entries),
+            'bytes': self.size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+
+class SharedSearchCache(object):
+    """Search responses cache shared by all processes on host
+
+    Backing file (preferably on tmpfs) is mapped into each worker, so the
+    cache survives worker restarts. Memory is split into buckets of `ways`
+    fixed size slots, key hash selects bucket, least recently used slot
+    of the bucket is replaced. Values are zlib compressed if large.
+
+    Readers don't take locks: each slot has a sequence number which writer
+    makes odd before and even after update, reader retries or misses
+    if sequence changed while copying. Writers lock the bucket with
+    fcntl byte-range lock (plus a thread lock for in-process writers).
+    Backing file of other geometry is replaced, old workers keep their
+    mapping of the unlinked file until restart.
+    """
+    MAGIC = 'OPSEARCH-SHCACHE-2'
+    FILE_HEADER = struct.Struct('<32sIII')
+    HEADER_SIZE = 4096
+    # seq, key hash, expire, atime, key length, data length, flags
+    SLOT = struct.Struct('<IQddHIH')
+    SEQ = struct.Struct('<I')
+    ATIME = struct.Struct('<d')
+    FLAG_ZLIB = 1
+    COMPRESS_MIN = 1024
+
+    def __init__(self, filename, ttl=60, max_bytes=64 << 20, slot_size=32 << 10, ways=8):
+        self.filename = filename
+        self.ttl = ttl
+        self.slot_size = slot_size
+        self.ways = ways
+        self.buckets = max(max_bytes // (slot_size * ways), 1)
+        self.file_size = self.HEADER_SIZE + self.buckets * ways * slot_size
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.fd = self.open_file()
+        self.mm = mmap.mmap(self.fd, self.file_size, mmap.MAP_SHARED,
+                            mmap.PROT_READ | mmap.PROT_WRITE)
+
+    def open_file(self):
+        """returns fd of backing file, file of other geometry or version
+        is replaced with a new one (never truncated, running workers may
+        still have it mapped and would get SIGBUS)"""
+        lock_fd = os.open(self.filename + '.lock', os.O_RDWR | os.O_CREAT, 0600)
+        fcntl.lockf(lock_fd, fcntl.LOCK_EX)
+        try:
+            expected = self.FILE_HEADER.pack(self.MAGIC, self.buckets, self.ways, self.slot_size)
+            try:
+                fd = os.open(self.filename, os.O_RDWR)
+            except OSError:
+                fd = None
+            if fd is not None:
+                header = os.read(fd, self.FILE_HEADER.size)
+                if header == expected and os.fstat(fd).st_size == self.file_size:
+                    return fd
+                os.close(fd)
+            temp_name = "%s.%d" % (self.filename, os.getpid())
+            fd = os.open(temp_name, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0600)
+            os.ftruncate(fd, self.file_size)
+            os.write(fd, expected)
+            os.rename(temp_name, self.filename)
+            return fd
+        finally:
+            fcntl.lockf(lock_fd, fcntl.LOCK_UN)
+            os.close(lock_fd)
+
+    def __len__(self):
+        return self.stats()['items']
+
+    def key_hash(self, key):
+        return struct.unpack('<Q', hashlib.sha1(key).digest()[:8])[0] or 1
+
+    def slot_offset(self, bucket, way):
+        return self.HEADER_SIZE + (bucket * self.ways + way) * self.slot_size
+
+    def read_slot(self, offset, key_hash, key, now):
+        """returns value or None, doesn't lock"""
+        mm = self.mm
+        for attempt in range(3):
+            header = mm[offset:offset + self.SLOT.size]
+            seq, slot_hash, expire, atime, key_len, data_len, flags = self.SLOT.unpack(header)
+            if seq & 1:
+                continue
+            if slot_hash != key_hash or expire < now:
+                return None
+            start = offset + self.SLOT.size
+            slot_key = mm[start:start + key_len]
+            data = mm[start + key_len:start + key_len + data_len]
+            if self.SEQ.unpack_from(mm, offset)[0] != seq:
+                continue
+            if slot_key != key:
+                return None
+            self.ATIME.pack_into(mm, offset + 20, now)
+            if flags & self.FLAG_ZLIB:
+                data = zlib.decompress(data)
+            return data
+        return None
+
+    def get(self, key):
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        key_hash = self.key_hash(key)
+        bucket = key_hash % self.buckets
+        now = time()
+        for way in range(self.ways):
+            offset = self.slot_offset(bucket, way)
+            if self.SLOT.unpack_from(self.mm, offset)[1] != key_hash:
+                continue
+            data = self.read_slot(offset, key_hash, key, now)
+            if data is not None:
+                self.hits += 1
+                return data
+        self.misses += 1
+        return None
+
+    def put(self, key, value):
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        flags = 0
+        if len(value) >= self.COMPRESS_MIN:
+            value = zlib.compress(value, 1)
+            flags |= self.FLAG_ZLIB
+        if self.SLOT.size + len(key) + len(value) > self.slot_size or len(key) > 0xffff:
+            return
+        key_hash = self.key_hash(key)
+        bucket = key_hash % self.buckets
+        now = time()
+        with self.lock:
+            fcntl.lockf(self.fd, fcntl.LOCK_EX, 1, bucket)
+            try:
+                victim = None
+                victim_time = None
+                for way in range(self.ways):
+                    offset = self.slot_offset(bucket, way)
+                    seq, slot_hash, expire, atime = self.SLOT.unpack_from(self.mm, offset)[:4]
+                    if slot_hash == key_hash or not slot_hash or expire < now:
+                        victim = offset
+                        break
+                    if victim is None or atime < victim_time:
+                        victim, victim_time = offset, atime
+                else:
+                    self.evictions += 1
+                self.write_slot(victim, key_hash, key, value, flags, now)
+            finally:
+                fcntl.lockf(self.fd, fcntl.LOCK_UN, 1, bucket)
+
+    def write_slot(self, offset, key_hash, key, value, flags, now):
+        mm = self.mm
+        seq = self.SEQ.unpack_from(mm, offset)[0] | 1
+        self.SEQ.pack_into(mm, offset, seq)
+        start = offset + self.SLOT.size
+        mm[start:start + len(key)] = key
+        mm[start + len(key):start + len(key) + len(value)] = value
+        header = self.SLOT.pack(seq, key_hash, now + self.ttl, now,
+                                len(key), len(value), flags)
+        mm[offset + self.SEQ.size:offset + self.SLOT.size] = header[self.SEQ.size:]
+        self.SEQ.pack_into(mm, offset, (seq + 1) & 0xffffffff)
+
+    def clear(self):
+        with self.lock:
+            for bucket in range(self.buckets):
+                fcntl.lockf(self.fd, fcntl.LOCK_EX, 1, bucket)
+                try:
+                    for way in range(self.ways):
+                        offset = self.slot_offset(bucket, way)
+                        seq = self.SEQ.unpack_from(self.mm, offset)[0] | 1
+                        self.SEQ.pack_into(self.mm, offset, seq)
+                        self.mm[offset + self.SEQ.size:offset + self.SLOT.size] = \
+                            '\0' * (self.SLOT.size - self.SEQ.size)
+                        self.SEQ.pack_into(self.mm, offset, (seq + 1) & 0xffffffff)
+                finally:
+                    fcntl.lockf(self.fd, fcntl.LOCK_UN, 1, bucket)
+
+    def stats(self):
+        items = 0
+        size = 0
+        now = time()
+        for bucket in range(self.buckets):
+            for way in range(self.ways):
+                slot = self.SLOT.unpack_from(self.mm, self.slot_offset(bucket, way))
+                if slot[1] and slot[2] >= now:
+                    items += 1
+                    size += slot[4] + slot[5]
+        return {
+            'items': items,
+            'bytes': size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'shared': self.filename,
+        }
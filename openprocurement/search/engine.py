@@ -1,6 +1,10 @@
 # -*- coding: utf-8 -*-
+import os
+import re
+import fcntl
 from logging import getLogger
 from time import time, sleep, localtime, strftime
+from threading import Event, Lock
 from restkit import request
 from retrying import retry
 import simplejson as json
@@ -8,6 +12,7 @@ import simplejson as json
 from elasticsearch import Elasticsearch
 from elasticsearch.helpers import bulk
 from elasticsearch.client import IndicesClient
+from elasticsearch.serializer import JSONSerializer
 from elasticsearch.exceptions import ElasticsearchException, NotFoundError
 
 from openprocurement.search.version import __version__
@@ -15,6 +20,45 @@ from openprocurement.search.utils import SharedFileDict
 
 logger = getLogger(__name__)
 
+# index keys (BaseIndex.__index_name__) of each search index set,
+# search_<set> and rename_<key> options override them, see init_search_map
+search_index_sets = {
+    'lots': ['lots'],
+    'assets': ['assets'],
+    'auctions': ['auctions'],
+    'auctions2': ['auctions2'],
+    'auctions3': ['auctions', 'auctions2'],
+    'tenders': ['tenders', 'oldocds'],
+    'plans': ['plans'],
+    'orgs': ['orgs'],
+}
+
+# sort argument to field, also used for index warmers
+sorting_map = {
+    'date': 'date',
+    'dateModified': 'dateModified',
+    'datePublished': 'datePublished',
+    'value': 'value.amount',
+    'budget': 'budget.amount',
+}
+
+
+class RawJSONSerializer(JSONSerializer):
+    """keeps response body undecoded, used by raw search client"""
+    def loads(self, s):
+        return s
+
+
+class RawItems(json.RawJSON):
+    """json array of docs spliced from elastic response, serialized as is
+    by simplejson, first doc is decoded on demand (for etag)"""
+    def __init__(self, encoded_json, first_json):
+        json.RawJSON.__init__(self, encoded_json)
+        self.first_json = first_json
+
+    def first(self):
+        return json.loads(self.first_json)
+
 
 class SearchEngine(object):
     """Search Engine
@@ -31,6 +75,8 @@ class SearchEngine(object):
         'update_wait': 5,
         'error_wait': 10,
         'start_wait': 1,
+        'search_coalesce': 1,
+        'search_raw': 0,
     }
     es_options = {
         'max_retries': 3,
@@ -50,6 +96,7 @@ class SearchEngine(object):
             self.config.update(config)
             self.config['update_wait'] = int(self.config['update_wait'])
         self.names_db = SharedFileDict(self.config.get('index_names'))
+        self.current_indexes = dict()
         self.elatic_host = self.config.get('elastic_host')
         if role and (role + '_elastic_host') in self.config:
             self.elatic_host = self.config[role + '_elastic_host']
@@ -63,10 +110,23 @@ class SearchEngine(object):
         self.bulk_buffer = dict()
         self.bulk_errors = False
         self.should_exit = False
+        self.coalesce = int(self.config.get('search_coalesce') or 0)
+        self.search_aliases = int(self.config.get('search_aliases') or 0)
+        self.alias_prefix = self.config.get('search_alias_prefix') or 'search_'
+        self.raw_elastic = None
+        if role == 'search' and int(self.config.get('search_raw') or 0):
+            self.raw_elastic = Elasticsearch([self.elatic_host],
+                serializer=RawJSONSerializer(), **self.es_options)
+        self.inflight = dict()
+        self.inflight_lock = Lock()
+        self.stat_coalesced = 0
+        self.notify_pending = dict()
+        self.notify_state = dict()
+        self.notify_stat = None
 
     def init_search_map(self, search_map={}):
         if search_map:
-            self.search_index_map.update(search_map)
+            self.search_index_map.update((k, list(v)) for k, v in search_map.items())
         # update index_name from config.ini
         for k in self.search_index_map.keys():
             names = self.config.get('search_' + k)
@@ -82,8 +142,26 @@ class SearchEngine(object):
                 new_name = self.config.get('rename_' + names[i])
                 if new_name:
                     names[i] = new_name
+        # yearly tender partitions are searched with current tenders
+        tenders = self.search_index_map.get('tenders', [])
+        if self.tender_active_key() in tenders:
+            tenders.extend(key for year, key in self.tender_partitions()
+                           if key not in tenders)
         logger.debug("Search indexes %s", str(self.search_index_map))
 
+    def tender_partitions(self):
+        """list of (year, index key) of yearly tender partitions, tenders
+        dated before tender_partition_until are kept there instead of
+        current tenders index, first partition also has all older ones"""
+        until = int(self.config.get('tender_partition_until') or 0)
+        if not until:
+            return []
+        first = int(self.config.get('tender_partition_from') or 2015)
+        return [(year, 'tenders_%d' % year) for year in range(first, until)]
+
+    def tender_active_key(self):
+        return self.config.get('rename_tenders') or 'tenders'
+
     def start_in_subprocess(self):
         # create copy of elastic connection
         self.elastic = Elasticsearch([self.elatic_host],
@@ -111,9 +189,15 @@ class SearchEngine(object):
         self.names_db[key] = str(name)
 
     def get_current_indexes(self, index_keys=None):
-        index_names = list()
         if not index_keys:
             index_keys = self.index_list
+        # resolved names are kept until names_db is reread or changed
+        if self.names_db.is_expired():
+            self.names_db.read()
+        cache_key = (self.names_db.version, tuple(index_keys))
+        if cache_key in self.current_indexes:
+            return self.current_indexes[cache_key]
+        index_names = list()
         for key in index_keys:
             if hasattr(key, '__index_name__'):
                 key = key.__index_name__
@@ -122,7 +206,29 @@ class SearchEngine(object):
                 name = self.get_index(key + '.next')
             if name:
                 index_names.append(name)
-        return ','.join(index_names)
+        index_names = ','.join(index_names)
+        if len(self.current_indexes) > 100:
+            self.current_indexes.clear()
+        self.current_indexes[cache_key] = index_names
+        return index_names
+
+    def search_alias(self, index_set):
+        return self.alias_prefix + index_set
+
+    def index_set_names(self, index_set):
+        """names to search index set, read alias of set (maintained by
+        index_worker) if search_aliases is enabled or current indexes"""
+        if self.search_aliases:
+            if index_set in search_index_sets:
+                return self.search_alias(index_set)
+            # subsets (see search_server.tenders_index_set) use alias of each index
+            return ','.join(self.search_index_map[index_set])
+        return self.get_current_indexes(self.search_index_map[index_set])
+
+    def index_set_current(self, index_set):
+        """current (physical) index names of set, aliases don't change
+        on switch so cache keys and generations use these names"""
+        return self.get_current_indexes(self.search_index_map[index_set])
 
     def index_names_dict(self):
         self.names_db.read()
@@ -152,9 +258,12 @@ class SearchEngine(object):
         stats = indices.stats(index_name)
         return stats['indices'][index_name]['primaries']
 
-    def search(self, body, start=0, limit=0, index=None, index_keys=None, index_set=None):
+    def search(self, body, start=0, limit=0, index=None, index_keys=None, index_set=None,
+               sort_values=False, raw=False):
+        """returns dict of items, total and start, with raw (if search_raw
+        is enabled) items are RawItems, see raw_search"""
         if not index and index_set:
-            index_keys = self.search_index_map[index_set]
+            index = self.index_set_names(index_set)
         if not index:
             index = self.get_current_indexes(index_keys)
         if not index:
@@ -163,15 +272,100 @@ class SearchEngine(object):
             limit = 10
         if self.debug:
             logger.debug("SEARCH %s %d %d %s", index, start, limit, body)
+        raw = raw and self.raw_elastic is not None and not sort_values
+        if self.coalesce:
+            return self.coalesced_search(index, body, start, limit, sort_values, raw)
+        if raw:
+            return self.raw_search(index, body, start, limit)
+        return self.elastic_search(index, body, start, limit, sort_values)
+
+    def coalesced_search(self, index, body, start, limit, sort_values=False, raw=False):
+        """identical concurrent searches share one elastic request,
+        each caller gets own copy of result dict (items are shared)"""
+        key = (index, json.dumps(body, sort_keys=True), start, limit, sort_values, raw)
+        with self.inflight_lock:
+            call = self.inflight.get(key)
+            leader = call is None
+            if leader:
+                call = self.inflight[key] = SearchCall()
+        if not leader:
+            call.event.wait(int(self.config['elastic_timeout']))
+            if call.result is not None:
+                self.stat_coalesced += 1
+                return dict(call.result)
+            if raw:
+                return self.raw_search(index, body, start, limit)
+            return self.elastic_search(index, body, start, limit, sort_values)
+        try:
+            if raw:
+                call.result = self.raw_search(index, body, start, limit)
+            else:
+                call.result = self.elastic_search(index, body, start, limit, sort_values)
+        finally:
+            with self.inflight_lock:
+                self.inflight.pop(key, None)
+            call.event.set()
+        return dict(call.result)
+
+    def elastic_search(self, index, body, start, limit, sort_values=False):
+        """returns items, total and start, with sort_values also
+        sort values of the last hit (for cursor pagination)"""
         try:
             res = self.elastic.search(index=index,
                 body=body, from_=start, size=limit)
         except ElasticsearchException as e:
             logger.error("elastic.search %s", str(e))
             res = {"error": unicode(e), "items": []}
+        return self.search_result(res, start, sort_values)
+
+    RAW_HITS_RE = re.compile(r'^\{"hits":\{"total":(\d+)(?:,"hits":\[(.*)\])?\}\}$', re.S)
+    RAW_SOURCE = '{"_source":'
+    RAW_SEPARATOR = '},{"_source":'
+
+    def raw_search(self, index, body, start, limit):
+        """search without decoding docs, elastic returns only total and
+        _source of hits (filter_path), docs are cut out of response text,
+        falls back to decoding if response has other format or number of
+        docs found by separator isn't expected"""
+        try:
+            data = self.raw_elastic.search(index=index, body=body,
+                from_=start, size=limit, filter_path='hits.total,hits.hits._source')
+        except ElasticsearchException as e:
+            logger.error("elastic.search %s", str(e))
+            return {"error": unicode(e), "items": []}
+        match = self.RAW_HITS_RE.match(data)
+        hits = match and match.group(2)
+        if hits and not (hits.startswith(self.RAW_SOURCE) and hits.endswith('}')):
+            match = None
+        # separator may also occur inside doc (nested object with _source
+        # key), then number of split hits differs from expected
+        if hits and match:
+            expected = min(limit, int(match.group(1)) - start)
+            if hits.count(self.RAW_SEPARATOR) + 1 != expected:
+                match = None
+        if not match:
+            try:
+                res = json.loads(data)
+            except ValueError as e:
+                logger.error("elastic.search bad response %s", str(e))
+                return {"error": "bad response", "items": []}
+            return self.search_result(res, start)
+        items = []
+        if hits:
+            hits = hits[len(self.RAW_SOURCE):-1]
+            first = hits.split(self.RAW_SEPARATOR, 1)[0]
+            items = RawItems('[' + hits.replace(self.RAW_SEPARATOR, ',') + ']', first)
+        return {
+            'items': items,
+            'total': int(match.group(1)),
+            'start': start
+        }
+
+    def search_result(self, res, start, sort_values=False):
+        """convert elastic response to items, total and start"""
         if 'hits' not in res:
             if 'error' in res:
-                return res
+                return {"error": unicode(res['error']), "items": []}
             logger.error("elastic.search bad response")
             res = {"error": "bad response", "items": []}
             return res
@@ -185,8 +379,144 @@ class SearchEngine(object):
             'total': hits.get('total', 0),
             'start': start
         }
+        if sort_values and hits.get('hits'):
+            res['sort_values'] = hits['hits'][-1].get('sort')
         return res
 
+    def aggregate(self, body, index=None, index_keys=None, index_set=None):
+        """count search (no hits) for total and aggregations, results are
+        kept in elastic shard query cache until index refresh"""
+        if not index and index_set:
+            index = self.index_set_names(index_set)
+        if not index:
+            index = self.get_current_indexes(index_keys)
+        if not index:
+            return {"error": "current index not found"}
+        if self.debug:
+            logger.debug("AGGREGATE %s %s", index, body)
+        try:
+            res = self.elastic.search(index=index, body=body,
+                search_type='count', params={'query_cache': 'true'})
+        except ElasticsearchException as e:
+            logger.error("elastic.search %s", str(e))
+            return {"error": unicode(e)}
+        if 'hits' not in res:
+            return {"error": "bad response"}
+        return {
+            'total': res['hits'].get('total', 0),
+            'aggregations': res.get('aggregations', {}),
+        }
+
+    def msearch(self, searches):
+        """run list of (index_set, body, start, limit, sort_values) searches
+        in one _msearch request, returns list of results as of search"""
+        request_body = list()
+        results = list()
+        for index_set, body, start, limit, sort_values in searches:
+            index = self.index_set_names(index_set)
+            if not index:
+                results.append({"error": "current index not found"})
+                continue
+            body = dict(body, size=limit)
+            if start:
+                body['from'] = start
+            request_body.append({'index': index})
+            request_body.append(body)
+            results.append(None)
+        if self.debug:
+            logger.debug("MSEARCH %s", request_body)
+        if not request_body:
+            return results
+        try:
+            responses = self.elastic.msearch(body=request_body)['responses']
+        except ElasticsearchException as e:
+            logger.error("elastic.msearch %s", str(e))
+            responses = [{"error": unicode(e)}] * (len(request_body) // 2)
+        responses = iter(responses)
+        for n, (index_set, body, start, limit, sort_values) in enumerate(searches):
+            if results[n] is None:
+                results[n] = self.search_result(next(responses), start, sort_values)
+        return results
+
+    def scan(self, body, index=None, index_keys=None, index_set=None,
+             size=500, scroll='1m'):
+        """start scroll over all matched docs, returns total and iterator
+        of hits _source, body without sort uses fast scan search type"""
+        if not index and index_set:
+            index = self.index_set_names(index_set)
+        if not index:
+            index = self.get_current_indexes(index_keys)
+        if not index:
+            raise ValueError("current index not found")
+        if self.debug:
+            logger.debug("SCAN %s %s", index, body)
+        params = {}
+        if 'sort' not in body:
+            params['search_type'] = 'scan'
+        res = self.elastic.search(index=index, body=body,
+            scroll=scroll, size=size, **params)
+        return res['hits']['total'], self.scroll_hits(res, scroll)
+
+    def scroll_hits(self, res, scroll):
+        """yields _source of hits, scroll is cleared if iteration stops"""
+        scroll_id = res.get('_scroll_id')
+        hits = res['hits']['hits']
+        try:
+            while True:
+                for h in hits:
+                    yield h.get('_source', {})
+                if not scroll_id:
+                    break
+                res = self.elastic.scroll(scroll_id=scroll_id, scroll=scroll)
+                scroll_id = res.get('_scroll_id')
+                if res['_shards'].get('failed'):
+                    raise ElasticsearchException("scroll failed on %d shards" %
+                                                 res['_shards']['failed'])
+                hits = res['hits']['hits']
+                if not hits:
+                    break
+        finally:
+            if scroll_id:
+                try:
+                    self.elastic.clear_scroll(body=scroll_id)
+                except ElasticsearchException as e:
+                    logger.warning("elastic.clear_scroll %s", str(e))
+
+    def notify_filename(self):
+        return "%s.notify" % self.config.get('index_names')
+
+    def toporgs_filename(self):
+        """top orgs snapshot written by update_orgs"""
+        return self.config.get('toporgs_file') or \
+            "%s.toporgs.json" % self.config.get('index_names')
+
+    def export_lock_filename(self):
+        """lock file of export slots shared by search workers"""
+        return self.config.get('search_export_lock') or \
+            "%s.export" % self.config.get('index_names')
+
+    def read_notify(self):
+        """reload index generations if notify file was replaced"""
+        try:
+            st = os.stat(self.notify_filename())
+        except OSError:
+            return self.notify_state
+        st_key = (st.st_ino, st.st_mtime, st.st_size)
+        if st_key != self.notify_stat:
+            try:
+                with open(self.notify_filename()) as fp:
+                    self.notify_state = json.load(fp)
+                self.notify_stat = st_key
+            except (IOError, ValueError) as e:
+                logger.warning("Can't read notify %s", str(e))
+        return self.notify_state
+
+    def index_generation(self, index_names):
+        """returns generations of comma separated index names"""
+        state = self.read_notify()
+        return ','.join([str(state.get(name, {}).get('generation', 0))
+                         for name in index_names.split(',')])
+
     def master_heartbeat(self, value=None):
         filename = "%s.heartbeat" % self.config.get('index_names')
         if value:
@@ -240,9 +570,18 @@ class SearchEngine(object):
         return self.last_heartbeat_value
 
 
+class SearchCall(object):
+    """In-flight search shared by coalesced callers"""
+    def __init__(self):
+        self.event = Event()
+        self.result = None
+
+
 class IndexEngine(SearchEngine):
     """Indexer Engine
     """
+    # forget notify state of indexes not updated for a week
+    notify_expire = 7 * 86400
 
     def __init__(self, config={}, role='index'):
         super(IndexEngine, self).__init__(config, role)
@@ -266,22 +605,54 @@ class IndexEngine(SearchEngine):
         return True
 
     def set_alias(self, alias_name, index_name):
+        """point alias to comma separated index names, old indexes are
+        removed from alias in the same atomic update_aliases request"""
         indices = IndicesClient(self.elastic)
-        old_index = alias_name + '_20*'
+        new_names = set(n for n in index_name.split(',') if n)
         try:
-            indices.delete_alias(index=old_index, name=alias_name)
+            old_names = set(indices.get_alias(name=alias_name).keys())
         except NotFoundError:
-            pass
+            old_names = set()
         except Exception as e:
             logger.error("Alias %s for %s not created: %s", alias_name, index_name, str(e))
             return
+        if old_names == new_names:
+            return
+        actions = [{'remove': {'index': n, 'alias': alias_name}}
+                   for n in sorted(old_names - new_names)]
+        actions += [{'add': {'index': n, 'alias': alias_name}}
+                    for n in sorted(new_names - old_names)]
         try:
-            indices.put_alias(index=index_name, name=alias_name, body={})
+            indices.update_aliases(body={'actions': actions})
         except Exception as e:
             logger.error("Alias %s for %s not created: %s", alias_name, index_name, str(e))
             return
         logger.info("Set alias %s -> %s", alias_name, index_name)
 
+    def update_search_aliases(self, index_key=None):
+        """point read alias of each search index set which includes
+        index_key (or any index of this worker) to its current indexes"""
+        if not self.search_aliases:
+            return
+        if index_key:
+            own_keys = [index_key]
+        else:
+            own_keys = [index.__index_name__ for index in self.index_list]
+        for index_set, index_keys in sorted(self.search_index_map.items()):
+            if not any(key in own_keys for key in index_keys):
+                continue
+            alias_name = self.search_alias(index_set)
+            missing = [key for key in index_keys if not self.get_current_indexes([key])]
+            if len(missing) == len(index_keys):
+                logger.error("Alias %s not updated, no current index of %s",
+                             alias_name, ','.join(index_keys))
+                continue
+            if missing:
+                # same as search without aliases, but totals are partial
+                logger.error("Alias %s without %s, no current index",
+                             alias_name, ','.join(missing))
+            self.set_alias(alias_name, self.get_current_indexes(index_keys))
+
     def create_index(self, index_name, body):
         indices = IndicesClient(self.elastic)
         indices.create(index_name, body=body)
@@ -298,15 +669,32 @@ class IndexEngine(SearchEngine):
         return found
 
     @retry(stop_max_attempt_number=5, wait_fixed=5000)
-    def test_exists(self, index_name, meta):
+    def get_version(self, index_name, meta):
+        """version of doc in index or None if not found"""
         try:
             found = self.elastic.get(index_name,
                 doc_type=meta.get('doc_type'),
                 id=meta['id'],
                 _source=False)
         except NotFoundError:
-            return False
-        return found['_version'] >= meta['version']
+            return None
+        return found['_version']
+
+    def test_exists(self, index_name, meta):
+        version = self.get_version(index_name, meta)
+        return version is not None and version >= meta['version']
+
+    @retry(stop_max_attempt_number=5, wait_fixed=5000)
+    def find_version(self, index_names, meta):
+        """(index name, version) of doc in any of comma separated
+        indexes or (None, None) if not found"""
+        docs = [{'_index': name, '_type': meta.get('doc_type'), '_id': meta['id']}
+                for name in index_names.split(',')]
+        found = self.elastic.mget(body={'docs': docs}, _source=False)
+        for doc in found['docs']:
+            if doc.get('found'):
+                return doc['_index'], doc['_version']
+        return None, None
 
     def index_item(self, index_name, item, ignore_bulk=False):
         # bulk insert
@@ -316,6 +704,7 @@ class IndexEngine(SearchEngine):
         # signle insert
         meta = item['meta']
         retry_count = 0
+        self.notify_item(index_name, item)
         while True:
             try:
                 res = self.elastic.index(index_name,
@@ -337,6 +726,51 @@ class IndexEngine(SearchEngine):
 
         return None
 
+    def notify_item(self, index_name, item):
+        modified = item.get('data', {}).get('dateModified') or ''
+        if modified >= self.notify_pending.get(index_name, ''):
+            self.notify_pending[index_name] = modified
+
+    def publish_notify(self):
+        """publish "index advanced to dateModified / generation" for indexes
+        updated since last call (after refresh of them), search servers
+        check notify file mtime"""
+        if not self.notify_pending:
+            return
+        # make updates visible before new generation is published, else
+        # search servers may cache old results under the new generation
+        try:
+            indices = IndicesClient(self.elastic)
+            indices.refresh(index=','.join(sorted(self.notify_pending)))
+        except ElasticsearchException as e:
+            logger.error("Can't refresh %s before notify: %s",
+                ','.join(sorted(self.notify_pending)), str(e))
+        filename = self.notify_filename()
+        now = time()
+        try:
+            with open(filename + '.lock', 'w') as lock_fp:
+                fcntl.lockf(lock_fp, fcntl.LOCK_EX)
+                try:
+                    with open(filename) as fp:
+                        state = json.load(fp)
+                except (IOError, ValueError):
+                    state = dict()
+                for name in state.keys():
+                    if now - state[name].get('time', 0) > self.notify_expire:
+                        state.pop(name)
+                for name, modified in self.notify_pending.items():
+                    info = state.setdefault(name, {'generation': 0, 'modified': ''})
+                    info['generation'] += 1
+                    info['modified'] = max(info['modified'], modified)
+                    info['time'] = int(now)
+                with open(filename + '.tmp', 'w') as fp:
+                    json.dump(state, fp)
+                os.rename(filename + '.tmp', filename)
+        except (IOError, OSError) as e:
+            logger.error("Can't publish notify %s", str(e))
+            return
+        self.notify_pending = dict()
+
     def bulk_index(self, index_name, item):
         if index_name not in self.bulk_buffer:
             self.bulk_buffer[index_name] = list()
@@ -344,6 +778,7 @@ class IndexEngine(SearchEngine):
         if len(items_list) >= 100:
             self.flush_bulk()
         items_list.append(item)
+        self.notify_item(index_name, item)
         return True
 
     def flush_bulk(self):
@@ -389,6 +824,7 @@ class IndexEngine(SearchEngine):
 
         self.bulk_buffer = dict()
         self.bulk_errors = False
+        self.publish_notify()
 
     def index_by_type(self, doc_type, item):
         for index in self.index_list:
@@ -479,6 +915,7 @@ class IndexEngine(SearchEngine):
             if self.config['check_on_start']:
                 for index in self.index_list:
                     index.check_on_start()
+            self.update_search_aliases()
 
         # start main loop
         allow_reindex = not self.slave_mode
@@ -8,8 +8,21 @@ from multiprocessing import Process
 from pkgutil import get_data
 from logging import getLogger
 
+from openprocurement.search.engine import sorting_map
+
 logger = getLogger(__name__)
 
+# fields of terms aggregations (facets) loaded by warmers
+warmer_agg_fields = ['status', 'procurementMethodType']
+
+
+def mapping_has_field(mapping, field):
+    for name in field.split('.'):
+        mapping = mapping.get('properties', {}).get(name)
+        if not mapping:
+            return False
+    return True
+
 
 class BaseIndex(object):
     """Search Index Interface
@@ -23,6 +36,7 @@ class BaseIndex(object):
         'index_parallel': 1,
         'index_speed': 500,
         'error_wait': 10,
+        'index_warmers': 1,
     }
     allow_async_reindex = False
     force_next_reindex = False
@@ -115,7 +129,7 @@ class BaseIndex(object):
     def create_index(self, name):
         return
 
-    def create_tender_index(self, name, common, tender, lang_list):
+    def create_tender_index(self, name, common, tender, lang_list, meta=None):
         logger.info("Create new index %s from %s %s %s", name, common, tender, lang_list)
         common = json.loads(get_data(__name__, common))
         tender = json.loads(get_data(__name__, tender))
@@ -143,8 +157,58 @@ class BaseIndex(object):
                 analysis['analyzer']['all_index']['filter'].append(stemmer)
                 analysis['analyzer']['all_search']['filter'].append(stemmer)
         tender['settings']['index']['number_of_shards'] = self.config['number_of_shards']
+        if meta:
+            tender['mappings'][doc_type]['_meta'] = meta
+        if self.config['index_warmers']:
+            tender['warmers'] = self.index_warmers(tender['mappings'][doc_type])
         self.engine.create_index(name, body=tender)
 
+    def warmup_queries(self, mapping):
+        """returns dict of name and search body which load fielddata
+        of sort fields (see sorting_map) and facets fields"""
+        queries = dict()
+        for field in sorted(set(sorting_map.values())):
+            if mapping_has_field(mapping, field):
+                queries['sort_' + field.replace('.', '_')] = {
+                    'query': {'match_all': {}},
+                    'sort': [{field: {'order': 'desc'}}],
+                }
+        aggs = dict((field, {'terms': {'field': field}})
+                    for field in warmer_agg_fields
+                    if mapping_has_field(mapping, field))
+        if aggs:
+            queries['facets'] = {'query': {'match_all': {}}, 'aggs': aggs}
+        return queries
+
+    def index_warmers(self, mapping):
+        """warmers run by elastic on each new segment before it is
+        searchable, so first sorted queries don't load fielddata"""
+        return dict((name, {'types': [], 'source': body})
+                    for name, body in self.warmup_queries(mapping).items())
+
+    def warmup_index(self, index_name):
+        """run warm-up queries once on every shard of index before
+        it becomes current (covers indexes created without warmers)"""
+        try:
+            info = self.engine.index_info(index_name)
+            mapping = info['mappings'][self.source.__doc_type__]
+        except Exception as e:
+            logger.error("[%s] Warm-up failed: %s", index_name, str(e))
+            return
+        start = time.time()
+        for name, body in sorted(self.warmup_queries(mapping).items()):
+            # primary and replica copies keep own fielddata
+            for preference in ('_primary', '_replica_first'):
+                if self.engine.should_exit:
+                    return
+                try:
+                    self.engine.elastic.search(index=index_name, body=body,
+                        size=1, preference=preference)
+                except Exception as e:
+                    logger.warning("[%s] Warm-up query %s failed: %s",
+                        index_name, name, str(e))
+        logger.info("[%s] Warm-up done in %1.1f sec", index_name, time.time() - start)
+
     def new_index(self, is_async=False):
         index_key = self.__index_name__
         index_key_next = "{}.next".format(index_key)
@@ -184,7 +248,11 @@ class BaseIndex(object):
             logger.info("Change current %s index %s -> %s",
                         index_key, old_index, name)
             if self.check_index(name):
+                if self.config['index_warmers']:
+                    self.warmup_index(name)
                 self.engine.set_index(index_key, name)
+                # switch read aliases before old index is deleted
+                self.engine.update_search_aliases(index_key)
             self.last_current_index = name
             # assert(self.current_index == name)
             if old_index:
@@ -1,6 +1,6 @@
 # -*- coding: utf-8 -*-
 from datetime import datetime
-from openprocurement.search.index import BaseIndex
+from openprocurement.search.index import BaseIndex, logger
 
 
 class TenderIndex(BaseIndex):
@@ -10,10 +10,24 @@ class TenderIndex(BaseIndex):
 
     allow_async_reindex = True
 
+    partition_checked = None
+
+    # max size of remembered partitions of tenders
+    PARTITIONS_MEMO = 100000
+
     def after_init(self):
         self.set_reindex_options(
             self.config.get('tender_reindex', '5,6'),
             self.config.get('tender_check', '1,1'))
+        self.partitions = dict(self.engine.tender_partitions())
+        # tender id -> partition index key, set when item is routed
+        self.item_partitions = dict()
+        self.partition_until = 0
+        if self.partitions:
+            self.partition_until = max(self.partitions) + 1
+            # tenders modified before bound can't be dated after it,
+            # source keeps this skip after each reset
+            self.source.min_skip_until = '%d-01-01' % self.partition_until
 
     def need_reindex(self):
         if not self.current_index:
@@ -21,10 +35,98 @@ class TenderIndex(BaseIndex):
         if self.force_next_reindex:
             self.force_next_reindex = False
             return True
+        if self.partition_changed():
+            return True
         if self.index_age() > self.max_age:
             return datetime.now().isoweekday() >= self.reindex_day
         return False
 
+    def partition_changed(self):
+        """current index was built with other tender_partition_until"""
+        name = self.current_index
+        if name == self.partition_checked:
+            return False
+        try:
+            info = self.engine.index_info(name)
+            meta = info['mappings'][self.source.__doc_type__].get('_meta', {})
+        except Exception as e:
+            logger.error("[%s] Can't check partition: %s", name, str(e))
+            return False
+        self.partition_checked = name
+        if int(meta.get('partition_until') or 0) != self.partition_until:
+            logger.info("[%s] Partition changed %s -> %s, need reindex", name,
+                        meta.get('partition_until'), self.partition_until)
+            return True
+        return False
+
+    def item_year(self, item):
+        try:
+            return int(item['data']['date'][:4])
+        except (KeyError, TypeError, ValueError):
+            return None
+
+    def item_partition(self, item):
+        """index key of yearly partition of tender or None if it belongs
+        to current tenders index"""
+        if not self.partition_until:
+            return None
+        year = self.item_year(item)
+        if year is None or year >= self.partition_until:
+            return None
+        return self.partitions.get(year) or self.partitions[min(self.partitions)]
+
+    def remember_partition(self, item_id, partition):
+        if len(self.item_partitions) >= self.PARTITIONS_MEMO:
+            self.item_partitions.clear()
+        self.item_partitions[item_id] = partition
+
+    def test_exists(self, index_name, info):
+        if not self.partition_until:
+            return super(TenderIndex, self).test_exists(index_name, info)
+        # partition known from date of indexed tender is checked first
+        partition = self.item_partitions.get(info['id'])
+        if partition and index_name == self.current_index:
+            name = self.engine.get_current_indexes([partition])
+            version = name and self.engine.get_version(name, info)
+            if version:
+                return version >= info['version']
+        version = self.engine.get_version(index_name, info)
+        if version is not None:
+            return version >= info['version']
+        # not in main index, other partitions are probed only if
+        # partition is unknown or tender isn't there (date moved)
+        names = self.engine.get_current_indexes(sorted(self.partitions.values()))
+        if not names:
+            return False
+        name, version = self.engine.find_version(names, info)
+        if name is None:
+            return False
+        key = [k for k in self.partitions.values()
+               if self.engine.get_current_indexes([k]) == name]
+        if key:
+            self.remember_partition(info['id'], key[0])
+        return version >= info['version']
+
+    def index_item(self, index_name, item):
+        partition = self.item_partition(item)
+        if partition:
+            # reindex leaves partitions as is, updates are routed to them
+            if index_name != self.current_index:
+                return None
+            item_id = item['data'].get('id')
+            known = self.item_partitions.get(item_id)
+            if known and known != partition:
+                logger.warning("[%s] Tender %s moved from %s to %s", index_name,
+                               item_id, known, partition)
+            self.remember_partition(item_id, partition)
+            partition_name = self.engine.get_current_indexes([partition])
+            if not partition_name:
+                logger.warning("[%s] No index of %s for %s, indexed in %s", index_name,
+                               partition, item_id, index_name)
+            else:
+                index_name = partition_name
+        return super(TenderIndex, self).index_item(index_name, item)
+
     def before_index_item(self, item):
         entity = self.source.procuring_entity(item)
         if entity:
@@ -65,6 +167,65 @@ class TenderIndex(BaseIndex):
 
         return False
 
+    def create_index(self, name):
+        common = 'settings/common.json'
+        tender = 'settings/tender.json'
+        lang_list = self.config.get('tender_index_lang', '').split(',')
+        meta = None
+        if self.partition_until:
+            meta = {'partition_until': self.partition_until}
+        self.create_tender_index(name, common, tender, lang_list, meta)
+
+
+class TenderPartitionIndex(TenderIndex):
+    """Tenders of one year (see tender_partition_until), index is built
+    once from tenders modified since start of year and then updated by
+    TenderIndex which routes old tenders to partitions
+    """
+    def __init__(self, engine, source, config={}, year=None):
+        self.year = year
+        self.__index_name__ = 'tenders_%d' % year
+        super(TenderPartitionIndex, self).__init__(engine, source, config)
+
+    def after_init(self):
+        super(TenderPartitionIndex, self).after_init()
+        # old tenders are rarely modified, don't check last indexed age
+        self.set_reindex_options('', self.config.get('tender_partition_check', '1,0'))
+        self.first_year = min(self.partitions)
+        # first partition also has all older tenders
+        self.source.min_skip_until = None
+        if self.year > self.first_year:
+            self.source.min_skip_until = '%d-01-01' % self.year
+
+    def need_reindex(self):
+        if not self.current_index:
+            return True
+        if self.force_next_reindex:
+            self.force_next_reindex = False
+            return True
+        return False
+
+    def index_source(self, index_name=None, reset=False, reindex=False):
+        if not reindex:
+            return
+        return BaseIndex.index_source(self, index_name, reset, reindex)
+
+    def test_exists(self, index_name, info):
+        """on reindex tenders found in main index or other partitions
+        aren't of this year and aren't fetched from API"""
+        if index_name != self.current_index:
+            keys = [TenderIndex.__index_name__] + [k for k in self.partitions.values()
+                                  if k != self.__index_name__]
+            names = self.engine.get_current_indexes(keys)
+            if names and self.engine.find_version(names, info)[0]:
+                return True
+        return BaseIndex.test_exists(self, index_name, info)
+
+    def index_item(self, index_name, item):
+        if self.item_partition(item) != 'tenders_%d' % self.year:
+            return None
+        return BaseIndex.index_item(self, index_name, item)
+
     def create_index(self, name):
         common = 'settings/common.json'
         tender = 'settings/tender.json'
@@ -10,14 +10,14 @@ import logging.config
 from ConfigParser import ConfigParser
 
 from openprocurement.search.version import __version__
-from openprocurement.search.engine import IndexEngine, logger
+from openprocurement.search.engine import IndexEngine, search_index_sets, logger
 from openprocurement.search.utils import decode_bool_values, chage_process_user_group
 
 from openprocurement.search.source.orgs import OrgsSource
 from openprocurement.search.index.orgs import OrgsIndex
 
 from openprocurement.search.source.tender import TenderSource
-from openprocurement.search.index.tender import TenderIndex
+from openprocurement.search.index.tender import TenderIndex, TenderPartitionIndex
 
 from openprocurement.search.source.ocds import OcdsSource
 from openprocurement.search.index.ocds import OcdsIndex
@@ -98,12 +98,16 @@ def main():
     try:
         global engine
         engine = IndexEngine(config)
+        engine.init_search_map(search_index_sets)
         if config.get('orgs_db', None):
             source = OrgsSource(config, True)
             OrgsIndex(engine, source, config)
         if config.get('tender_api_url', None):
             source = TenderSource(config, True)
             TenderIndex(engine, source, config)
+            for year, key in engine.tender_partitions():
+                source = TenderSource(config, True)
+                TenderPartitionIndex(engine, source, config, year)
         if config.get('ocds_dir', None):
             source = OcdsSource(config)
             OcdsIndex(engine, source, config)
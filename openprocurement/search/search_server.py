@@ -2,23 +2,26 @@
 from gevent import monkey
 monkey.patch_all()
 
+import re
 import sys
+import zlib
+import base64
+import urllib
+import hashlib
 import simplejson as json
 from ConfigParser import ConfigParser
-from flask import Flask, request, jsonify, abort
+from flask import Flask, request, jsonify, abort, g
+from werkzeug.datastructures import MultiDict
+from werkzeug.urls import url_decode
+from functools import wraps, partial
 from time import time
 
 from openprocurement.search.version import __version__
-from openprocurement.search.index.asset import AssetIndex
-from openprocurement.search.index.dgf_lot import DgfLotIndex
-from openprocurement.search.index.auction import AuctionIndex, AuctionIndex2
-from openprocurement.search.index.tender import TenderIndex
-from openprocurement.search.index.ocds import OcdsIndex
-from openprocurement.search.index.plan import PlanIndex
-from openprocurement.search.index.orgs import OrgsIndex
 
-from openprocurement.search.engine import SearchEngine
-from openprocurement.search.utils import decode_bool_values
+from openprocurement.search.engine import SearchEngine, search_index_sets, sorting_map
+from openprocurement.search.cache import SearchCache, SharedSearchCache
+from openprocurement.search.suggest import OrgsSuggest, TopOrgs
+from openprocurement.search.utils import decode_bool_values, SharedSlots
 
 # Flask config
 
@@ -43,16 +46,54 @@ search_config = decode_bool_values(search_config)
 # create engine
 
 search_engine = SearchEngine(search_config, role='search')
-search_engine.init_search_map({
-    'lots': [DgfLotIndex],
-    'assets': [AssetIndex],
-    'auctions': [AuctionIndex],
-    'auctions2': [AuctionIndex2],
-    'auctions3': [AuctionIndex, AuctionIndex2],
-    'tenders': [TenderIndex, OcdsIndex],
-    'plans': [PlanIndex],
-    'orgs': [OrgsIndex],
-})
+search_engine.init_search_map(search_index_sets)
+
+# create responses cache
+
+search_etag = int(search_config.get('search_etag') or 0)
+search_cache = None
+if int(search_config.get('search_cache_ttl') or 0):
+    if search_config.get('search_cache_file'):
+        search_cache = SharedSearchCache(
+            search_config['search_cache_file'],
+            ttl=int(search_config['search_cache_ttl']),
+            max_bytes=int(search_config.get('search_cache_size') or 64) << 20,
+            slot_size=int(search_config.get('search_cache_slot') or 32) << 10)
+    else:
+        search_cache = SearchCache(
+            ttl=int(search_config['search_cache_ttl']),
+            max_bytes=int(search_config.get('search_cache_size') or 64) << 20,
+            max_items=int(search_config.get('search_cache_items') or 10000))
+
+facets_cache = None
+if int(search_config.get('search_facets_ttl', 60)):
+    facets_cache = SearchCache(ttl=int(search_config.get('search_facets_ttl', 60)),
+        max_bytes=16 << 20, max_items=2000)
+
+# in-memory orgsuggest prefix index
+
+orgs_suggest = None
+if int(search_config.get('orgsuggest_memory') or 0):
+    orgs_suggest = OrgsSuggest(search_engine,
+        max_orgs=int(search_config['orgsuggest_memory']),
+        reload_interval=int(search_config.get('orgsuggest_reload') or 3600))
+
+# top orgs snapshot (see update_orgs)
+
+top_orgs = TopOrgs(search_engine.toporgs_filename())
+
+# limit concurrent exports of all gunicorn workers
+
+export_limit = int(search_config.get('search_export_limit', 2))
+export_size = int(search_config.get('search_export_size') or 500)
+export_slots = None
+if export_limit > 0:
+    export_slots = SharedSlots(search_engine.export_lock_filename(), export_limit)
+
+# edge-ngram subfields of prefix_map fields, see settings/common.json
+
+PREFIX_MAX_GRAM = 32
+prefix_subfields = set()
 
 # query fileds map
 
@@ -73,6 +114,8 @@ prefix_map = {
     'asset_cav_like': 'classification.id',
     'asset_cpvs_like': 'additionalClassifications.id',
 }
+if int(search_config.get('prefix_subfields') or 0):
+    prefix_subfields.update(prefix_map.values())
 match_map = {
     'id': 'id',
     'asid': 'assetID',
@@ -154,13 +197,6 @@ dates_map = {
 fulltext_map = {
     'query': '_all',
 }
-sorting_map = {
-    'date': 'date',
-    'dateModified': 'dateModified',
-    'datePublished': 'datePublished',
-    'value': 'value.amount',
-    'budget': 'budget.amount',
-}
 auction_map_fields = [
     'address',
     'auctionID',
@@ -177,6 +213,147 @@ short_auction_map_fields = [
     'items.id'
 ]
 
+# _source presets of view= argument, view=full (default) is whole document
+tender_list_fields = [
+    'id',
+    'tenderID',
+    'title',
+    'status',
+    'procurementMethodType',
+    'procuringEntity.name',
+    'procuringEntity.identifier',
+    'value',
+    'date',
+    'dateModified',
+    'enquiryPeriod',
+    'tenderPeriod',
+]
+plan_list_fields = [
+    'id',
+    'planID',
+    'status',
+    'budget',
+    'classification',
+    'procuringEntity.name',
+    'procuringEntity.identifier',
+    'tender.procurementMethodType',
+    'tender.tenderPeriod',
+    'datePublished',
+    'dateModified',
+]
+auction_list_fields = [
+    'id',
+    'auctionID',
+    'dgfID',
+    'title',
+    'status',
+    'procurementMethodType',
+    'procuringEntity.name',
+    'value',
+    'auctionPeriod',
+    'date',
+    'dateModified',
+]
+asset_list_fields = [
+    'id',
+    'assetID',
+    'title',
+    'status',
+    'assetType',
+    'assetCustodian.name',
+    'value',
+    'date',
+    'dateModified',
+]
+lot_list_fields = [
+    'id',
+    'lotID',
+    'title',
+    'status',
+    'lotType',
+    'lotCustodian.name',
+    'date',
+    'dateModified',
+]
+view_fields = {
+    'tenders': {
+        'list': tender_list_fields,
+        'card': tender_list_fields + [
+            'description',
+            'mainProcurementCategory',
+            'procurementMethod',
+            'procuringEntity',
+            'minimalStep',
+            'auctionPeriod',
+            'awardPeriod',
+            'items.description',
+            'items.classification',
+            'items.quantity',
+            'items.unit',
+            'items.deliveryAddress',
+            'lots.id',
+            'lots.title',
+            'lots.status',
+            'lots.value',
+        ],
+    },
+    'plans': {
+        'list': plan_list_fields,
+        'card': plan_list_fields + [
+            'additionalClassifications',
+            'procuringEntity',
+            'tender',
+            'items.description',
+            'items.classification',
+            'items.quantity',
+            'items.unit',
+        ],
+    },
+    'auctions': {
+        'list': auction_list_fields,
+        'card': auction_list_fields + [
+            'description',
+            'procurementMethod',
+            'procuringEntity',
+            'minimalStep',
+            'guarantee',
+            'enquiryPeriod',
+            'tenderPeriod',
+            'items.description',
+            'items.classification',
+            'items.address',
+            'items.quantity',
+            'items.unit',
+        ],
+    },
+    'assets': {
+        'list': asset_list_fields,
+        'card': asset_list_fields + [
+            'description',
+            'classification',
+            'additionalClassifications',
+            'address',
+            'assetCustodian',
+            'quantity',
+            'unit',
+            'relatedLot',
+        ],
+    },
+    'lots': {
+        'list': lot_list_fields,
+        'card': lot_list_fields + [
+            'description',
+            'lotCustodian',
+            'assets',
+            'auctions',
+        ],
+    },
+}
+# always returned, needed for etag and cursor
+view_required_fields = ['id', 'dateModified']
+field_name_re = re.compile(r'^[A-Za-z_][A-Za-z0-9_.]*$')
+MAX_FIELDS = 50
+
 
 # convert auction response to map items
 
@@ -202,11 +379,158 @@ def convert_auction_map_items(in_items, short=False):
                     'address': item.get('address', None) or auction.get('address', None),
                     'value': item.get('value', None) or auction.get('value', None),
                 }
+                if 'geo' in item:
+                    map_item['geo'] = item['geo']
             out_items.append(map_item)
 
     return out_items
 
 
+# search responses cache
+
+
+def search_cache_key(index_set):
+    """returns request path with normalized args and current index names,
+    and current index names"""
+    args = list()
+    for key, values in sorted(request.args.lists()):
+        for value in sorted(values):
+            args.append((key, value.encode('utf-8')))
+    if callable(index_set):
+        index_set = index_set(request.args)
+    index_names = search_engine.index_set_current(index_set)
+    key = "%s?%s|%s" % (request.path, urllib.urlencode(args), index_names)
+    return key, index_names
+
+
+def search_etag_value(key, generation):
+    """etag of query key (with index names) and index generations, same
+    for cached and not cached response"""
+    return hashlib.md5(key.encode('utf-8') + '|' + generation).hexdigest()
+
+
+def not_modified(etag):
+    response = search_server.response_class(status=304)
+    response.set_etag(etag)
+    return response
+
+
+def cached_search(index_set, cache=None):
+    """cache successful json responses of search view and answer
+    conditional requests
+
+    index_set is name or function of request args, entries are keyed by
+    current index names and their generations (see IndexEngine.publish_notify)
+    so an index switch or update makes them unreachable.
+    With search_etag responses get ETag of the same key and generations,
+    so conditional requests are answered without search if no index of
+    the set was updated since.
+    Responses are kept in search_cache unless other cache is given.
+    """
+    view_cache = search_cache if cache is None else cache
+
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if view_cache is None and not search_etag or search_server.debug:
+                return view(*args, **kwargs)
+            try:
+                key, index_names = search_cache_key(index_set)
+            except Exception:
+                return view(*args, **kwargs)
+            # index_worker bumps generation after each update of index
+            generation = search_engine.index_generation(index_names)
+            etag = None
+            if search_etag:
+                etag = search_etag_value(key, generation)
+                if etag in request.if_none_match:
+                    return not_modified(etag)
+            if view_cache is not None:
+                cache_key = key + '|' + generation
+                value = view_cache.get(cache_key)
+                if value is not None:
+                    response = search_server.response_class(value,
+                        mimetype='application/json')
+                    if etag:
+                        response.set_etag(etag)
+                    return response
+            response = view(*args, **kwargs)
+            if response.status_code != 200 or g.get('skip_cache'):
+                return response
+            if etag:
+                response.set_etag(etag)
+            if view_cache is not None:
+                view_cache.put(cache_key, response.get_data())
+            return response
+        return wrapper
+    return decorator
+
+
+def search_response(res):
+    if 'error' in res:
+        g.skip_cache = True
+    return jsonify(res)
+
+
+def auctions_index_set(args):
+    index_key = int(args.get('index') or 1)
+    return ['auctions', 'auctions2', 'auctions3'][index_key - 1]
+
+
+# yearly tender partitions (see TenderPartitionIndex)
+
+tender_partitions = dict((key, year) for year, key in search_engine.tender_partitions())
+
+
+def date_args_years(args):
+    """first and last year of date_start and date_end, None if not set"""
+    first = last = None
+    value = args.get('date_start') or ''
+    if value[:4].isdigit():
+        first = int(value[:4])
+    value = args.get('date_end') or ''
+    if value[:4].isdigit():
+        last = int(value[:4])
+        # date_end is exclusive
+        if value[4:] in ('', '-01-01', '-01-01T00:00', '-01-01T00:00:00'):
+            last -= 1
+    return first, last
+
+
+def tenders_index_set(args):
+    """tenders set limited to partitions which years overlap date_start
+    and date_end, subsets are added to search_index_map on first use"""
+    if not tender_partitions:
+        return 'tenders'
+    first, last = date_args_years(args)
+    if first is None and last is None:
+        return 'tenders'
+    first = first or 0
+    last = 9999 if last is None else last
+    lowest = min(tender_partitions.values())
+    until = max(tender_partitions.values()) + 1
+    active = search_engine.tender_active_key()
+    keys = list()
+    for key in search_engine.search_index_map['tenders']:
+        if key in tender_partitions:
+            year = tender_partitions[key]
+            # first partition also has all older tenders
+            if year == lowest:
+                if first > year:
+                    continue
+            elif not first <= year <= last:
+                continue
+        elif key == active and last < until:
+            continue
+        keys.append(key)
+    if not keys or keys == search_engine.search_index_map['tenders']:
+        return 'tenders'
+    index_set = 'tenders.' + '.'.join(keys)
+    if index_set not in search_engine.search_index_map:
+        search_engine.search_index_map[index_set] = keys
+    return index_set
+
+
 # build query helper functions
 
 
@@ -224,19 +548,42 @@ def match_query(query, field, type_=None, operator=None, analyzer=None, force_lo
     return {"match": {field: query}}
 
 
-def prefix_query(query, field, force_lower=False):
+def terms_filter(query, field, force_lower=False):
+    """filter equivalent of match query with whitespace analyzer and
+    operator or, fields are indexed with whitespace_lower analyzer"""
+    terms = list()
+    for q in query:
+        if force_lower:
+            q = q.lower()
+        terms.extend(q.split())
+    return {"terms": {field: terms}}
+
+
+def prefix_query(query, field, force_lower=False, as_filter=False):
+    """prefix query or filter, if field has edge-ngram .prefix subfield
+    filter is replaced by exact terms filter on subfield"""
     body = []
+    terms = []
     for q in query:
         if force_lower:
             q = q.lower()
-        query = {field: {"prefix": q}}
+        if as_filter and field in prefix_subfields and 0 < len(q) <= PREFIX_MAX_GRAM:
+            terms.append(q)
+            continue
+        if as_filter:
+            query = {field: q}
+        else:
+            query = {field: {"prefix": q}}
         body.append({"prefix": query})
+    if terms:
+        body.append({"terms": {field + ".prefix": terms}})
     if len(body) == 1:
         return body[0]
     return {"bool": {"should": body}}
 
 
-def range_query(query, field, force_float=False):
+def range_query(query, field, force_float=False, as_filter=False):
+    """range query or filter, same syntax except str prefix"""
     body = []
     for q in query:
         if q.find('-') < 0:
@@ -244,7 +591,7 @@ def range_query(query, field, force_float=False):
                 q = float(q)
                 res = {"range": {field: {"gte": q}}}
             else:
-                res = prefix_query([q], field)
+                res = prefix_query([q], field, as_filter=as_filter)
             body.append(res)
         else:
             beg, end = q.split('-', 1)
@@ -260,11 +607,22 @@ def range_query(query, field, force_float=False):
     return {"bool": {"should": body}}
 
 
+def round_date(query):
+    """round date with time (and now) down to minute so range filter
+    is the same for a minute and can be cached by elastic"""
+    if query.startswith('now'):
+        if '/' not in query:
+            query += '/m'
+    elif 'T' in query and '||' not in query:
+        query += '||/m'
+    return query
+
+
 def dates_query(query, args):
     op, key = args
     body = {"range": {
         key: {
-            op: query,
+            op: round_date(query),
             "time_zone": "+2:00",
         }}}
     return body
@@ -277,18 +635,105 @@ def append_dates_query(body, query, args):
             continue
         for rk, rv in q["range"].items():
             if rk == key:
-                rv[op] = query
+                rv[op] = round_date(query)
                 return
     match = dates_query(query, args)
     body.append(match)
 
 
+# cursor pagination
+
+# tie-break of cursor sort, not analyzed id subfield with doc values
+# (_uid would load fielddata on heap)
+CURSOR_TIEBREAK = 'id.sort'
+# sort values of hits without sort field (sorted last in both orders)
+CURSOR_MISSING = (None, 'Infinity', '-Infinity', float('inf'), float('-inf'),
+                  -2 ** 63, 2 ** 63 - 1)
+
+
+def encode_cursor(sort, values):
+    """opaque token of sort field, order and sort values of last hit"""
+    field, params = sort[0].items()[0]
+    token = json.dumps([field, params['order']] + list(values), separators=(',', ':'))
+    return base64.urlsafe_b64encode(token).rstrip('=')
+
+
+def decode_cursor(token, field, order):
+    """returns (value, id) of last hit, token must match current sort"""
+    try:
+        token = str(token)
+        token += '=' * (-len(token) % 4)
+        cursor = json.loads(base64.urlsafe_b64decode(token))
+        cursor_field, cursor_order, value, doc_id = cursor
+    except (TypeError, ValueError, UnicodeError):
+        raise ValueError('bad cursor')
+    if cursor_field != field or cursor_order != order:
+        raise ValueError('cursor does not match sort')
+    return value, doc_id
+
+
+def cursor_filter(token, field, order):
+    """keyset filter for hits after cursor in (field, id) order, hits
+    without field are sorted last (as in offset mode)"""
+    value, doc_id = decode_cursor(token, field, order)
+    op = 'gt' if order == 'asc' else 'lt'
+    after_id = {"range": {CURSOR_TIEBREAK: {op: doc_id}}}
+    missing = {"missing": {"field": field}}
+    if value in CURSOR_MISSING:
+        return {"bool": {"must": [missing, after_id]}}
+    return {"bool": {"should": [
+        {"range": {field: {op: value}}},
+        {"bool": {"must": [{"term": {field: value}}, after_id]}},
+        missing,
+    ]}}
+
+
+def paged_search(body, args, index_set, limit=10, max_limit=100, raw=True):
+    """search page by start and limit, or by cursor if cursor argument
+    is given (empty for first page), cursor pages cost the same at any
+    depth, response has next_cursor if there may be more hits.
+    With raw items may be undecoded (see SearchEngine.raw_search)"""
+    limit = int(args.get('limit') or limit)
+    limit = min(max(1, limit), max_limit)
+    if 'cursor' not in args:
+        start = int(args.get('start') or 0)
+        return search_engine.search(body, start, limit, index_set=index_set, raw=raw)
+    res = search_engine.search(body, 0, limit, index_set=index_set, sort_values=True)
+    values = res.pop('sort_values', None)
+    if values and len(res.get('items', [])) == limit:
+        res['next_cursor'] = encode_cursor(body['sort'], values)
+    return res
+
+
 # build query body
 
 
+def search_fields(args, view_set):
+    """_source include list by fields (comma separated) or view
+    preset of view_set, None for full documents"""
+    fields = args.get('fields')
+    view = args.get('view')
+    if fields:
+        fields = fields.split(',')
+        if len(fields) > MAX_FIELDS:
+            raise ValueError('too many fields')
+        if not all(field_name_re.match(f) for f in fields):
+            raise ValueError('bad fields')
+    elif view and view != 'full':
+        if view not in view_fields[view_set]:
+            raise ValueError('unknown view')
+        fields = view_fields[view_set][view]
+    else:
+        return None
+    return sorted(set(fields).union(view_required_fields))
+
+
 def prepare_search_body(args, default_sort='dateModified', source_fields=None):
+    """build filtered query, only full-text search is scored, all other
+    criteria go to filter which is cached by elastic"""
     force_lower = int(search_config.get('force_lower', 1))
-    body = list()
+    filters = list()
+    queries = list()
 
     if len(args) > MAX_SEARCH_ARGS:
         raise ValueError('Too many argumets')
@@ -300,8 +745,9 @@ def prepare_search_body(args, default_sort='dateModified', source_fields=None):
         field = prefix_map[key]
         query = args.getlist(key)
         match = prefix_query(query, field,
-            force_lower=force_lower)
-        body.append(match)
+            force_lower=force_lower,
+            as_filter=True)
+        filters.append(match)
 
     # ID's and states
     for key in match_map.keys():
@@ -309,11 +755,9 @@ def prepare_search_body(args, default_sort='dateModified', source_fields=None):
             continue
         field = match_map[key]
         query = args.getlist(key)
-        match = match_query(query, field,
-            operator='or',
-            analyzer='whitespace',
+        match = terms_filter(query, field,
             force_lower=force_lower)
-        body.append(match)
+        filters.append(match)
 
     # int/float range values ie value.amount
     for key in float_range_map.keys():
@@ -321,8 +765,8 @@ def prepare_search_body(args, default_sort='dateModified', source_fields=None):
             continue
         field = float_range_map[key]
         query = args.getlist(key)
-        match = range_query(query, field, force_float=True)
-        body.append(match)
+        match = range_query(query, field, force_float=True, as_filter=True)
+        filters.append(match)
 
     # str range values ie postal code
     for key in str_range_map.keys():
@@ -330,8 +774,8 @@ def prepare_search_body(args, default_sort='dateModified', source_fields=None):
             continue
         field = str_range_map[key]
         query = args.getlist(key)
-        match = range_query(query, field, force_float=False)
-        body.append(match)
+        match = range_query(query, field, force_float=False, as_filter=True)
+        filters.append(match)
 
     # date range
     for key in dates_map.keys():
@@ -339,7 +783,7 @@ def prepare_search_body(args, default_sort='dateModified', source_fields=None):
             continue
         field = dates_map[key]
         query = args.get(key)
-        append_dates_query(body, query, field)
+        append_dates_query(filters, query, field)
 
     # full-text search
     for key in fulltext_map.keys():
@@ -349,14 +793,7 @@ def prepare_search_body(args, default_sort='dateModified', source_fields=None):
         query = args.getlist(key)
         match = match_query(query, field,
             operator='and')
-        body.append(match)
-
-    if not body:
-        body = {'query': {'match_all': {}}}
-    elif len(body) == 1:
-        body = {'query': body[0]}
-    else:
-        body = {'query': {'bool': {'must': body}}}
+        queries.append(match)
 
     sort = args.get('sort') or default_sort
     order = args.get('order')
@@ -365,11 +802,42 @@ def prepare_search_body(args, default_sort='dateModified', source_fields=None):
         order = 'desc'
 
     if sort in sorting_map:
-        body['sort'] = {sorting_map[sort]: {'order': order}}
+        sort_field = sorting_map[sort]
     elif sort == '_score' and args.get('query'):
-        body.pop('sort')
+        sort_field = None
     else:
-        body['sort'] = {default_sort: {'order': 'desc'}}
+        sort_field, order = default_sort, 'desc'
+
+    # cursor pagination, see paged_search
+    if 'cursor' in args:
+        if not sort_field:
+            raise ValueError('cursor requires sort by field')
+        if args.get('cursor'):
+            filters.append(cursor_filter(args.get('cursor'), sort_field, order))
+
+    if len(queries) > 1:
+        queries = [{'bool': {'must': queries}}]
+
+    if filters:
+        if len(filters) == 1:
+            filtered = {'filter': filters[0]}
+        else:
+            filtered = {'filter': {'bool': {'must': filters}}}
+        if queries:
+            filtered['query'] = queries[0]
+        body = {'query': {'filtered': filtered}}
+    elif queries:
+        body = {'query': queries[0]}
+    else:
+        body = {'query': {'match_all': {}}}
+
+    if sort_field and 'cursor' in args:
+        body['sort'] = [
+            {sort_field: {'order': order, 'missing': '_last'}},
+            {CURSOR_TIEBREAK: {'order': order, 'unmapped_type': 'string'}},
+        ]
+    elif sort_field:
+        body['sort'] = {sort_field: {'order': order}}
 
     if source_fields is not None:
         body['_source'] = source_fields
@@ -378,71 +846,63 @@ def prepare_search_body(args, default_sort='dateModified', source_fields=None):
 
 
 @search_server.route('/tenders')
+@cached_search(tenders_index_set)
 def search_tenders():
     try:
         args = request.args
-        body = prepare_search_body(args, default_sort='date')
-        start = int(args.get('start') or 0)
-        limit = int(args.get('limit') or 10)
-        limit = min(max(1, limit), 100)
-        res = search_engine.search(body, start, limit, index_set='tenders')
+        fields = search_fields(args, 'tenders')
+        body = prepare_search_body(args, default_sort='date', source_fields=fields)
+        res = paged_search(body, args, tenders_index_set(args))
     except Exception as e:
         search_server.logger.exception("Error in tenders {}".format(e))
         res = {"error": "{}: {}".format(type(e).__name__, e)}
     if search_server.debug:
         res['body'] = body
-    return jsonify(res)
+    return search_response(res)
 
 
 @search_server.route('/plans')
+@cached_search('plans')
 def search_plans():
     try:
         args = request.args
-        body = prepare_search_body(args, default_sort='datePublished')
-        start = int(args.get('start') or 0)
-        limit = int(args.get('limit') or 10)
-        limit = min(max(1, limit), 100)
-        res = search_engine.search(body, start, limit, index_set='plans')
+        fields = search_fields(args, 'plans')
+        body = prepare_search_body(args, default_sort='datePublished', source_fields=fields)
+        res = paged_search(body, args, 'plans')
     except Exception as e:
         search_server.logger.exception("Error in plans {}".format(e))
         res = {"error": "{}: {}".format(type(e).__name__, e)}
     if search_server.debug:
         res['body'] = body
-    return jsonify(res)
+    return search_response(res)
 
 
 @search_server.route('/auctions')
+@cached_search(auctions_index_set)
 def search_auctions():
     try:
         args = request.args
-        body = prepare_search_body(args, default_sort='date')
-        start = int(args.get('start') or 0)
-        limit = int(args.get('limit') or 10)
-        limit = min(max(1, limit), 100)
-        index_key = int(args.get('index') or 1)
-        index_set = ['auctions', 'auctions2', 'auctions3'][index_key - 1]
-        res = search_engine.search(body, start, limit, index_set=index_set)
+        fields = search_fields(args, 'auctions')
+        body = prepare_search_body(args, default_sort='date', source_fields=fields)
+        res = paged_search(body, args, auctions_index_set(args))
     except Exception as e:
         search_server.logger.exception("Error in auctions {}".format(e))
         res = {"error": "{}: {}".format(type(e).__name__, e)}
     if search_server.debug:
         res['body'] = body
-    return jsonify(res)
+    return search_response(res)
 
 
 @search_server.route('/auctions.map')
+@cached_search(auctions_index_set)
 def search_auctions_map():
     try:
         args = request.args
         short = int(args.get('short') or 0)
         fields = short_auction_map_fields if short else auction_map_fields
         body = prepare_search_body(args, default_sort='date', source_fields=fields)
-        start = int(args.get('start') or 0)
-        limit = int(args.get('limit') or 100)
-        limit = min(max(1, limit), 1000)
-        index_key = int(args.get('index') or 1)
-        index_set = ['auctions', 'auctions2', 'auctions3'][index_key - 1]
-        res = search_engine.search(body, start, limit, index_set=index_set)
+        res = paged_search(body, args, auctions_index_set(args),
+            limit=100, max_limit=1000, raw=False)
         if res and 'items' in res:
             items = res.pop('items')
             res['count'] = len(items)
@@ -452,57 +912,206 @@ def search_auctions_map():
         res = {"error": "{}: {}".format(type(e).__name__, e)}
     if search_server.debug:
         res['body'] = body
-    return jsonify(res)
+    return search_response(res)
+
+
+# auctions map clusters
+
+# geohash precision for map zoom, cells are smaller than a tile
+# so one screen shows tens of clusters
+zoom_precision = [1, 1, 2, 2, 3, 3, 3, 4, 4, 5, 5, 5, 6, 6, 7, 7, 7, 8, 8, 9]
+MAP_CLUSTERS = 1000
+map_points_max = int(search_config.get('search_map_points') or 200)
+
+
+def parse_bbox(bbox):
+    """bbox argument top,left,bottom,right (lat,lon,lat,lon) to
+    geo_bounding_box corners, left > right crosses 180th meridian"""
+    top, left, bottom, right = [float(v) for v in bbox.split(',')]
+    if not (-90 <= bottom <= top <= 90 and -180 <= left <= 180 and -180 <= right <= 180):
+        raise ValueError('bad bbox')
+    return {
+        "top_left": {"lat": top, "lon": left},
+        "bottom_right": {"lat": bottom, "lon": right},
+    }
+
+
+def in_bbox(geo, bbox):
+    top_left, bottom_right = bbox['top_left'], bbox['bottom_right']
+    if not bottom_right['lat'] <= geo['lat'] <= top_left['lat']:
+        return False
+    if top_left['lon'] <= bottom_right['lon']:
+        return top_left['lon'] <= geo['lon'] <= bottom_right['lon']
+    return geo['lon'] >= top_left['lon'] or geo['lon'] <= bottom_right['lon']
+
+
+GEOHASH_BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+
+
+def geohash_cell(geohash):
+    """(top, left, bottom, right) of geohash cell"""
+    lat, lon = [-90.0, 90.0], [-180.0, 180.0]
+    even = True
+    for c in geohash:
+        bits = GEOHASH_BASE32.index(c)
+        for mask in (16, 8, 4, 2, 1):
+            interval = lon if even else lat
+            mid = (interval[0] + interval[1]) / 2
+            interval[0 if bits & mask else 1] = mid
+            even = not even
+    return lat[1], lon[0], lat[0], lon[1]
+
+
+def cell_in_bbox(geohash, bbox):
+    """geohash cell intersects bbox"""
+    top, left, bottom, right = geohash_cell(geohash)
+    top_left, bottom_right = bbox['top_left'], bbox['bottom_right']
+    if bottom > top_left['lat'] or top < bottom_right['lat']:
+        return False
+    if top_left['lon'] <= bottom_right['lon']:
+        return left <= bottom_right['lon'] and right >= top_left['lon']
+    return right >= top_left['lon'] or left <= bottom_right['lon']
+
+
+def map_clusters(aggregation, bbox=None):
+    """geohash_grid buckets to clusters with center of bounds of points,
+    cells outside bbox (other items of matched auctions) are skipped"""
+    clusters = list()
+    for b in aggregation.get('buckets', []):
+        bounds = b.get('bounds', {}).get('bounds')
+        if not bounds:
+            continue
+        if bbox and not cell_in_bbox(b['key'], bbox):
+            continue
+        top_left, bottom_right = bounds['top_left'], bounds['bottom_right']
+        clusters.append({
+            'geohash': b['key'],
+            'count': b['doc_count'],
+            'lat': (top_left['lat'] + bottom_right['lat']) / 2,
+            'lon': (top_left['lon'] + bottom_right['lon']) / 2,
+            'bounds': bounds,
+        })
+    return clusters
+
+
+@search_server.route('/auctions.clusters')
+@cached_search(auctions_index_set, cache=facets_cache)
+def search_auctions_clusters():
+    """auction items located in bbox, as geohash grid clusters for zoom
+    or as map items (see auctions.map) if not more than map_points_max
+    auctions are matched"""
+    try:
+        args = request.args
+        if not args.get('bbox'):
+            raise ValueError('bbox required')
+        bbox = parse_bbox(args['bbox'])
+        zoom = min(max(0, int(args.get('zoom') or 0)), len(zoom_precision) - 1)
+        body = prepare_search_body(args, default_sort='date', source_fields=auction_map_fields)
+        geo_filter = {"geo_bounding_box": {"items.geo": bbox, "type": "indexed"}}
+        query = body['query']
+        if 'filtered' not in query:
+            query = {'filtered': {'query': query}}
+        filters = [geo_filter]
+        if 'filter' in query['filtered']:
+            filters.insert(0, query['filtered']['filter'])
+            query['filtered']['filter'] = {'bool': {'must': filters}}
+        else:
+            query['filtered']['filter'] = geo_filter
+        body['query'] = query
+        index_set = auctions_index_set(args)
+        # items isn't nested, so points of all items of matched auctions
+        # are aggregated, map_clusters drops cells outside bbox
+        count_body = {'query': query, 'aggs': {'map': {
+            'filter': geo_filter,
+            'aggs': {'clusters': {
+                'geohash_grid': {
+                    'field': 'items.geo',
+                    'precision': zoom_precision[zoom],
+                    'size': MAP_CLUSTERS,
+                },
+                'aggs': {'bounds': {'geo_bounds': {'field': 'items.geo'}}},
+            }},
+        }}}
+        res = search_engine.aggregate(count_body, index_set=index_set)
+        if 'aggregations' in res:
+            aggs = res.pop('aggregations')
+            res['zoom'] = zoom
+            if res['total'] > map_points_max:
+                res['clusters'] = map_clusters(aggs.get('map', {}).get('clusters', {}), bbox)
+            else:
+                found = search_engine.search(body, 0, map_points_max, index_set=index_set)
+                if 'error' in found:
+                    res = found
+                else:
+                    items = convert_auction_map_items(found.get('items', []))
+                    res['items'] = [i for i in items if 'geo' in i and in_bbox(i['geo'], bbox)]
+    except Exception as e:
+        search_server.logger.exception("Error in auctions.clusters {}".format(e))
+        res = {"error": "{}: {}".format(type(e).__name__, e)}
+    return search_response(res)
 
 
 @search_server.route('/assets')
+@cached_search('assets')
 def search_assets():
     try:
         args = request.args
-        body = prepare_search_body(args, default_sort='date')
-        start = int(args.get('start') or 0)
-        limit = int(args.get('limit') or 10)
-        limit = min(max(1, limit), 100)
-        res = search_engine.search(body, start, limit, index_set='assets')
+        fields = search_fields(args, 'assets')
+        body = prepare_search_body(args, default_sort='date', source_fields=fields)
+        res = paged_search(body, args, 'assets')
     except Exception as e:
         search_server.logger.exception("Error in assets {}".format(e))
         res = {"error": "{}: {}".format(type(e).__name__, e)}
     if search_server.debug:
         res['body'] = body
-    return jsonify(res)
+    return search_response(res)
 
 
 @search_server.route('/lots')
+@cached_search('lots')
 def search_lots():
     try:
         args = request.args
-        body = prepare_search_body(args, default_sort='date')
-        start = int(args.get('start') or 0)
-        limit = int(args.get('limit') or 10)
-        limit = min(max(1, limit), 100)
-        res = search_engine.search(body, start, limit, index_set='lots')
+        fields = search_fields(args, 'lots')
+        body = prepare_search_body(args, default_sort='date', source_fields=fields)
+        res = paged_search(body, args, 'lots')
     except Exception as e:
         search_server.logger.exception("Error in lots {}".format(e))
         res = {"error": "{}: {}".format(type(e).__name__, e)}
     if search_server.debug:
         res['body'] = body
-    return jsonify(res)
+    return search_response(res)
 
 
 @search_server.route('/orgsuggest')
+@cached_search('orgs')
 def orgsuggest():
     # excact search
     if request.args.get('edrpou', ''):
         edrpou = request.args.getlist('edrpou')
         limit = len(edrpou)
         if limit > 100:
-            return jsonify({"error": "too many edrpou"})
+            return search_response({"error": "too many edrpou"})
         body = {"query": {"terms": {"edrpou": edrpou}}}
         res = search_engine.search(body, limit=limit, index_set='orgs')
-        return jsonify(res)
+        return search_response(res)
     # generate static top-orgs json
     toporgs = request.args.get('toporgs', '')
     if toporgs and int(toporgs) < 1001:
+        compress = 'gzip' in request.accept_encodings
+        rendered = top_orgs.render(int(toporgs), bool(request.args.get('plain', '')), compress)
+        if rendered:
+            # already has own etag, don't cache (may be compressed)
+            g.skip_cache = True
+            body, etag = rendered
+            if etag in request.if_none_match:
+                return not_modified(etag)
+            response = search_server.response_class(body, mimetype='application/json')
+            response.set_etag(etag)
+            response.headers['Vary'] = 'Accept-Encoding'
+            if compress:
+                response.headers['Content-Encoding'] = 'gzip'
+            return response
         body = {
             "query": {"match_all": {}},
             "sort": {"rank": {"order": "desc"}},
@@ -514,12 +1123,22 @@ def orgsuggest():
             for i in res['items']:
                 edrpou = i['edrpou']
                 items[edrpou] = i['name']
-            return jsonify(items)
-        return jsonify(res)
+            return search_response(items)
+        return search_response(res)
     # fulltext search
     query = request.args.get('query', '')
     if not query or len(query) > 50:
-        return jsonify({"error": "bad query"})
+        return search_response({"error": "bad query"})
+    limit = int(request.args.get('limit') or 10)
+    if limit < 1 or limit > 100:
+        return search_response({"error": "bad limit"})
+    # prefix search in memory, elastic is fallback for fuzzy search
+    if orgs_suggest is not None:
+        suggest_index = orgs_suggest.get()
+        if suggest_index is not None:
+            res = suggest_index.search(query, limit)
+            if res is not None:
+                return search_response(res)
     fuzziness = 0
     if len(query) > 8:
         fuzziness = 1
@@ -532,14 +1151,300 @@ def orgsuggest():
         "query": {"match": {"_all": _all}},
         "sort": {"rank": {"order": "desc"}},
     }
-    limit = int(request.args.get('limit') or 10)
-    if limit < 1 or limit > 100:
-        return jsonify({"error": "bad limit"})
     res = search_engine.search(body, limit=limit, index_set='orgs')
     if not res.get('items'):
         _all["fuzziness"] += 1
         res = search_engine.search(body, limit=limit, index_set='orgs')
-    return jsonify(res)
+    return search_response(res)
+
+
+# index set (or function of args) and default sort of search views
+# for export and msearch
+
+search_view_map = {
+    'tenders': (tenders_index_set, 'date'),
+    'plans': ('plans', 'datePublished'),
+    'auctions': (auctions_index_set, 'date'),
+    'assets': ('assets', 'date'),
+    'lots': ('lots', 'date'),
+}
+
+
+def view_set_rule(name='view_set'):
+    """route variable matching only search_view_map keys, so /export/count
+    isn't taken for /<view_set>/count (or count for export index set)"""
+    return '<any(%s):%s>' % (','.join(sorted(search_view_map)), name)
+
+
+# batched search
+
+MAX_MSEARCH = 10
+
+
+def msearch_args(query):
+    """sub-query args as url query string or dict of values or lists"""
+    if isinstance(query, basestring):
+        return url_decode(query)
+    args = MultiDict()
+    for key, value in query.items():
+        if isinstance(value, list):
+            args.setlist(key, [unicode(v) for v in value])
+        else:
+            args[key] = unicode(value)
+    return args
+
+
+@search_server.route('/msearch', methods=['POST'])
+def msearch():
+    """several searches in one elastic _msearch request, body is json list
+    of {"index": "tenders", "args": "status=active.tendering&limit=0"},
+    response has result (or error) for each sub-query in same order"""
+    data = request.get_json(force=True, silent=True)
+    if not isinstance(data, list) or not data or len(data) > MAX_MSEARCH:
+        response = jsonify({"error": "expected list of 1..%d searches" % MAX_MSEARCH})
+        response.status_code = 400
+        return response
+    searches = list()
+    errors = dict()
+    for n, sub in enumerate(data):
+        try:
+            index_set, default_sort = search_view_map[sub['index']]
+            args = msearch_args(sub.get('args') or {})
+            if callable(index_set):
+                index_set = index_set(args)
+            fields = search_fields(args, sub['index'])
+            body = prepare_search_body(args, default_sort=default_sort,
+                source_fields=fields)
+            start = 0 if 'cursor' in args else int(args.get('start') or 0)
+            limit = int(args.get('limit') or 10)
+            limit = min(max(0, limit), 100)
+            searches.append((index_set, body, start, limit, 'cursor' in args))
+        except Exception as e:
+            errors[n] = {"error": "{}: {}".format(type(e).__name__, e)}
+    try:
+        results = search_engine.msearch(searches)
+    except Exception as e:
+        search_server.logger.exception("Error in msearch {}".format(e))
+        return jsonify({"error": "{}: {}".format(type(e).__name__, e)})
+    for (index_set, body, start, limit, cursor), res in zip(searches, results):
+        values = res.pop('sort_values', None)
+        if values and limit and len(res.get('items', [])) == limit:
+            res['next_cursor'] = encode_cursor(body['sort'], values)
+    results = iter(results)
+    responses = [errors.get(n) or next(results) for n in range(len(data))]
+    return jsonify({"responses": responses})
+
+
+# counts and facets
+
+# facet name to field of each view, region and cpv/cav facets are
+# grouped by first two digits, date is histogram
+facet_fields = {
+    'tenders': {
+        'status': 'status',
+        'proc_type': 'procurementMethodType',
+        'region': 'procuringEntity.address.postalCode',
+        'cpv': 'items.classification.id',
+        'date': 'date',
+    },
+    'plans': {
+        'proc_type': 'tender.procurementMethodType',
+        'cpv': 'classification.id',
+        'date': 'datePublished',
+    },
+    'auctions': {
+        'status': 'status',
+        'proc_type': 'procurementMethodType',
+        'region': 'procuringEntity.address.postalCode',
+        'cav': 'items.classification.id',
+        'date': 'date',
+    },
+    'assets': {
+        'status': 'status',
+        'asset_type': 'assetType',
+        'region': 'assetCustodian.address.postalCode',
+        'cav': 'classification.id',
+        'date': 'date',
+    },
+    'lots': {
+        'status': 'status',
+        'lot_type': 'lotType',
+        'region': 'lotCustodian.address.postalCode',
+        'date': 'date',
+    },
+}
+prefix_facets = ('region', 'cpv', 'cav')
+facet_intervals = ('year', 'quarter', 'month', 'week', 'day')
+FACET_SIZE = 100
+
+
+def facet_aggregation(name, field, interval='month'):
+    if name == 'date':
+        return {"date_histogram": {
+            "field": field,
+            "interval": interval,
+            "time_zone": "+2:00",
+            "format": "yyyy-MM-dd",
+            "min_doc_count": 1,
+        }}
+    if name in prefix_facets:
+        # with prefix_subfields each filter is a term filter on .prefix,
+        # terms agg on it would load fielddata of all ngrams
+        return {"filters": {"filters": dict(
+            ("%02d" % n, prefix_query(["%02d" % n], field, as_filter=True))
+            for n in range(100))}}
+    return {"terms": {"field": field, "size": FACET_SIZE}}
+
+
+def facet_buckets(aggregation):
+    """list of key and count, zero counts are skipped"""
+    buckets = aggregation.get('buckets', [])
+    if isinstance(buckets, dict):
+        buckets = [dict(b, key=k) for k, b in sorted(buckets.items())]
+    facet = list()
+    for b in buckets:
+        if not b.get('doc_count'):
+            continue
+        facet.append({
+            'key': b.get('key_as_string') or b['key'],
+            'count': b['doc_count'],
+        })
+    return facet
+
+
+def facets_index_set(args):
+    index_set = search_view_map[request.view_args['view_set']][0]
+    if callable(index_set):
+        index_set = index_set(args)
+    return index_set
+
+
+@search_server.route('/%s/count' % view_set_rule())
+@cached_search(facets_index_set, cache=facets_cache)
+def search_count(view_set):
+    """number of docs matched by search args"""
+    if view_set not in search_view_map:
+        abort(404)
+    try:
+        args = request.args
+        body = prepare_search_body(args)
+        body.pop('sort', None)
+        res = search_engine.aggregate(body, index_set=facets_index_set(args))
+        res.pop('aggregations', None)
+    except Exception as e:
+        search_server.logger.exception("Error in count {}".format(e))
+        res = {"error": "{}: {}".format(type(e).__name__, e)}
+    return search_response(res)
+
+
+@search_server.route('/%s/facets' % view_set_rule())
+@cached_search(facets_index_set, cache=facets_cache)
+def search_facets(view_set):
+    """counts of docs matched by search args grouped by each of facet
+    arguments (see facet_fields), interval is date facet step"""
+    if view_set not in facet_fields:
+        abort(404)
+    try:
+        args = request.args
+        interval = args.get('interval') or 'month'
+        if interval not in facet_intervals:
+            raise ValueError('bad interval')
+        fields = facet_fields[view_set]
+        names = args.getlist('facet') or ['status']
+        for name in names:
+            if name not in fields:
+                raise ValueError('unknown facet %s' % name)
+        body = prepare_search_body(args)
+        body.pop('sort', None)
+        body['aggs'] = dict((name, facet_aggregation(name, fields[name], interval))
+                            for name in names)
+        res = search_engine.aggregate(body, index_set=facets_index_set(args))
+        if 'aggregations' in res:
+            aggs = res.pop('aggregations')
+            res['facets'] = dict((name, facet_buckets(aggs.get(name, {})))
+                                 for name in names)
+    except Exception as e:
+        search_server.logger.exception("Error in facets {}".format(e))
+        res = {"error": "{}: {}".format(type(e).__name__, e)}
+    return search_response(res)
+
+
+# streaming export
+
+EXPORT_CHUNK = 64 << 10
+
+
+def export_stream(hits, compress=False):
+    """yields NDJSON of hits in chunks of about EXPORT_CHUNK bytes,
+    gzip compressed if asked, error is reported as the last line"""
+    encoder = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None
+    chunk = list()
+    size = 0
+    try:
+        for doc in hits:
+            line = json.dumps(doc, separators=(',', ':')) + '\n'
+            chunk.append(line)
+            size += len(line)
+            if size >= EXPORT_CHUNK:
+                data = ''.join(chunk)
+                chunk, size = list(), 0
+                if encoder:
+                    data = encoder.compress(data)
+                if data:
+                    yield data
+    except Exception as e:
+        search_server.logger.exception("Error in export {}".format(e))
+        error = {"error": "{}: {}".format(type(e).__name__, e)}
+        chunk.append(json.dumps(error) + '\n')
+    data = ''.join(chunk)
+    if encoder:
+        data = encoder.compress(data) + encoder.flush()
+    if data:
+        yield data
+
+
+@search_server.route('/export/%s' % view_set_rule('index_set'))
+def export(index_set):
+    """all docs matched by search args as NDJSON, unsorted unless sort
+    is given, fields or view limits exported fields (see search_fields)"""
+    if index_set not in search_view_map or export_slots is None:
+        abort(404)
+    try:
+        args = request.args
+        fields = search_fields(args, index_set)
+        body = prepare_search_body(args, source_fields=fields)
+        if not args.get('sort'):
+            body.pop('sort', None)
+        index_set = search_view_map[index_set][0]
+        if callable(index_set):
+            index_set = index_set(args)
+    except Exception as e:
+        response = jsonify({"error": "{}: {}".format(type(e).__name__, e)})
+        response.status_code = 400
+        return response
+    slot = export_slots.acquire()
+    if slot is None:
+        response = jsonify({"error": "too many exports, try later"})
+        response.status_code = 429
+        return response
+    try:
+        total, hits = search_engine.scan(body, index_set=index_set, size=export_size)
+    except Exception as e:
+        export_slots.release(slot)
+        search_server.logger.exception("Error in export {}".format(e))
+        response = jsonify({"error": "{}: {}".format(type(e).__name__, e)})
+        response.status_code = 500
+        return response
+    compress = 'gzip' in request.accept_encodings
+    response = search_server.response_class(export_stream(hits, compress),
+        mimetype='application/x-ndjson')
+    response.headers['X-Total-Count'] = str(total)
+    response.headers['Vary'] = 'Accept-Encoding'
+    if compress:
+        response.headers['Content-Encoding'] = 'gzip'
+    # released when server closes response, also on client disconnect
+    response.call_on_close(partial(export_slots.release, slot))
+    return response
 
 
 @search_server.route('/heartbeat', methods=['GET', 'HEAD', 'POST'])
@@ -556,6 +1461,10 @@ def heartbeat():
         data['index_stats'] = search_engine.index_docs_count()
         if request.values.get('config', ''):
             data['search_config'] = search_config
+        if search_cache is not None:
+            data['search_cache'] = search_cache.stats()
+        if orgs_suggest is not None:
+            data['orgs_suggest'] = orgs_suggest.stats()
         if search_server.debug:
             data['debug'] = True
     elif key:
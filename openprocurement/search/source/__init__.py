@@ -20,6 +20,8 @@ class BaseSource:
     should_reset = False
     last_reset_time = 0
     client_user_agent = 'Search-Tenders/%s' % __version__
+    client_class = None
+    recorder = None
     cache_path = None
     cache_hits = 0
     cache_miss = 0
@@ -130,11 +132,21 @@ class BaseSource:
     def disable_cache(self):
         self.cache_path = None
 
+    def record_setpath(self, filename):
+        """record feed pages and documents to corpus file (see source.replay)"""
+        if not filename:
+            return
+        from openprocurement.search.source.replay import CorpusWriter
+        self.recorder = CorpusWriter(filename)
+        logger.info("Enable %s record to %s", self.__doc_type__, filename)
+
 
 class TendersClient(client.TendersClient):
     def __init__(self, *args, **kwargs):
         self.user_agent = kwargs.pop('user_agent', None)
         self.timeout = kwargs.pop('timeout', 300)
+        self.recorder = kwargs.pop('recorder', None)
+        self.resource = kwargs.get('resource', 'tenders')
         if self.timeout:
             setdefaulttimeout(self.timeout)
         super(TendersClient, self).__init__(*args, **kwargs)
@@ -143,3 +155,18 @@ class TendersClient(client.TendersClient):
         if 'User-Agent' not in self.headers and self.user_agent:
             self.headers['User-Agent'] = self.user_agent
         return super(TendersClient, self).request(*args, **kwargs)
+
+    def get_tenders(self, *args, **kwargs):
+        items = super(TendersClient, self).get_tenders(*args, **kwargs)
+        if self.recorder:
+            self.recorder.put_page(self.resource, items)
+        return items
+
+    def get_tender(self, *args, **kwargs):
+        tender = super(TendersClient, self).get_tender(*args, **kwargs)
+        if self.recorder:
+            self.recorder.put_doc(self.resource, tender)
+        return tender
+
+
+BaseSource.client_class = TendersClient
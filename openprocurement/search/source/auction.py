@@ -5,13 +5,26 @@ from retrying import retry
 from iso8601 import parse_date
 from socket import setdefaulttimeout
 
-from openprocurement.search.source import BaseSource, TendersClient
+from openprocurement.search.source import BaseSource
 from openprocurement.search.utils import restkit_error
 
 from logging import getLogger
 logger = getLogger(__name__)
 
 
+def location_geo_point(location):
+    """geo_point of item location or None if coordinates are missing,
+    not numbers, out of range or zero"""
+    try:
+        lat = float(unicode(location['latitude']).replace(',', '.'))
+        lon = float(unicode(location['longitude']).replace(',', '.'))
+    except (KeyError, TypeError, ValueError):
+        return None
+    if not (-90 <= lat <= 90 and -180 <= lon <= 180) or not (lat or lon):
+        return None
+    return {'lat': lat, 'lon': lon}
+
+
 class AuctionSource(BaseSource):
     """Auction Source
     """
@@ -33,6 +46,7 @@ class AuctionSource(BaseSource):
         'auction_file_cache': '',
         'auction_cache_allow': 'complete,cancelled,unsuccessful',
         'auction_cache_minage': 15,
+        'auction_record': '',
         'timeout': 30,
     }
 
@@ -44,6 +58,8 @@ class AuctionSource(BaseSource):
         self.config['auction_reseteach'] = int(self.config['auction_reseteach'] or 3)
         self.config['auction_resethour'] = int(self.config['auction_resethour'] or 0)
         self.client_user_agent += " (auctions) " + self.config['auction_user_agent']
+        if self.config['auction_record']:
+            self.record_setpath(self.config['auction_record'])
         if use_cache:
             self.cache_setpath(self.config['auction_file_cache'], self.config['auction_api_url'],
                 self.config['auction_api_version'], 'auctions')
@@ -77,6 +93,10 @@ class AuctionSource(BaseSource):
                 if 'unit' in item and 'quantity' in item:
                     key = 'quantity_' + item['unit']['code']
                     item[key] = item['quantity']
+                if item.get('location'):
+                    geo = location_geo_point(item['location'])
+                    if geo:
+                        item['geo'] = geo
         return auction
 
     def need_reset(self):
@@ -99,14 +119,15 @@ class AuctionSource(BaseSource):
             params['mode'] = self.config['auction_api_mode']
         if self.config['auction_limit']:
             params['limit'] = self.config['auction_limit']
-        self.client = TendersClient(
+        self.client = self.client_class(
             key=self.config['auction_api_key'],
             host_url=self.config['auction_api_url'],
             api_version=self.config['auction_api_version'],
             resource=self.config['auction_resource'],
             params=params,
             timeout=float(self.config['timeout']),
-            user_agent=self.client_user_agent)
+            user_agent=self.client_user_agent,
+            recorder=self.recorder)
         if self.config['auction_file_cache'] and self.cache_path:
             cache_minage = int(self.config['auction_cache_minage'])
             cache_date = datetime.now() - timedelta(days=cache_minage)
@@ -235,6 +256,7 @@ class AuctionSource2(AuctionSource):
         'auction2_file_cache': '',
         'auction2_cache_allow': 'complete,cancelled,unsuccessful',
         'auction2_cache_minage': 15,
+        'auction2_record': '',
         'auction_preload': 10000,  # FIXME
         'timeout': 30,
     }
@@ -248,6 +270,8 @@ class AuctionSource2(AuctionSource):
         self.config['auction2_resethour'] = int(self.config['auction2_resethour'] or 0)
         self.config['auction_preload'] = int(self.config['auction2_preload'] or 100)  # FIXME
         self.client_user_agent += " (auctions) " + self.config['auction2_user_agent']
+        if self.config['auction2_record']:
+            self.record_setpath(self.config['auction2_record'])
         if use_cache:
             self.cache_setpath(self.config['auction2_file_cache'], self.config['auction2_api_url'],
                 self.config['auction2_api_version'], 'auctions')
@@ -276,14 +300,15 @@ class AuctionSource2(AuctionSource):
             params['mode'] = self.config['auction2_api_mode']
         if self.config['auction2_limit']:
             params['limit'] = self.config['auction2_limit']
-        self.client = TendersClient(
+        self.client = self.client_class(
             key=self.config['auction2_api_key'],
             host_url=self.config['auction2_api_url'],
             api_version=self.config['auction2_api_version'],
             resource=self.config['auction2_resource'],
             params=params,
             timeout=float(self.config['timeout']),
-            user_agent=self.client_user_agent)
+            user_agent=self.client_user_agent,
+            recorder=self.recorder)
         if self.config['auction2_file_cache'] and self.cache_path:
             cache_minage = int(self.config['auction2_cache_minage'])
             cache_date = datetime.now() - timedelta(days=cache_minage)
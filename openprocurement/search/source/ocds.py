@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 from os import path, listdir
+from copy import deepcopy
 from time import mktime, time, sleep
 from fnmatch import fnmatch
 from iso8601 import parse_date
@@ -24,11 +25,14 @@ class OcdsSource(BaseSource):
         'ocds_minsize': 1000,
         'ocds_speed': 500,
         'ocds_skip_until': None,
+        'ocds_record': '',
     }
 
     def __init__(self, config={}):
         if config:
             self.config.update(config)
+        if self.config['ocds_record']:
+            self.record_setpath(self.config['ocds_record'])
         self.last_reset_time = 0
         self.last_files = []
         self.files = []
@@ -115,6 +119,7 @@ class OcdsSource(BaseSource):
         if not data.get('releases') and self.files:
             self.last_skipped = 'NOTSET'
             return
+        record_page = list()
         for r in data['releases']:
             if self.should_exit:
                 raise StopIteration()
@@ -125,12 +130,16 @@ class OcdsSource(BaseSource):
                 item['date'] = r['date']
             if 'dateModified' not in item:
                 item['dateModified'] = r['date']
+            if self.recorder:
+                record_page.append(deepcopy(item))
             if skip_until and skip_until > item['dateModified']:
                 self.last_skipped = item['dateModified']
                 continue
             yield self.patch_version(item)
             # limit ocds iterator to 1000 r/s
             sleep(1.0/float(self.config['ocds_speed']))
+        if self.recorder:
+            self.recorder.put_page(self.__doc_type__, record_page)
 
     def get(self, item):
         return self.patch_tender(item)
@@ -5,7 +5,7 @@ from iso8601 import parse_date
 from socket import setdefaulttimeout
 from retrying import retry
 
-from openprocurement.search.source import BaseSource, TendersClient
+from openprocurement.search.source import BaseSource
 from openprocurement.search.source.orgs import OrgsDecoder
 from openprocurement.search.utils import restkit_error
 
@@ -36,6 +36,7 @@ class PlanSource(BaseSource):
         'plan_user_agent': '',
         'plan_file_cache': '',
         'plan_cache_minage': 15,
+        'plan_record': '',
         'timeout': 30,
     }
 
@@ -47,6 +48,8 @@ class PlanSource(BaseSource):
         self.config['plan_reseteach'] = int(self.config['plan_reseteach'] or 3)
         self.config['plan_resethour'] = int(self.config['plan_resethour'] or 0)
         self.client_user_agent += " (plans) " + self.config['plan_user_agent']
+        if self.config['plan_record']:
+            self.record_setpath(self.config['plan_record'])
         if use_cache:
             self.cache_setpath(self.config['plan_file_cache'], self.config['plan_api_url'],
                 self.config['plan_api_version'], 'plans')
@@ -102,19 +105,20 @@ class PlanSource(BaseSource):
             params['mode'] = self.config['plan_api_mode']
         if self.config['plan_limit']:
             params['limit'] = self.config['plan_limit']
-        self.client = TendersClient(
+        self.client = self.client_class(
             key=self.config['plan_api_key'],
             host_url=self.config['plan_api_url'],
             api_version=self.config['plan_api_version'],
             resource=self.config['plan_resource'],
             params=params,
             timeout=float(self.config['timeout']),
-            user_agent=self.client_user_agent)
+            user_agent=self.client_user_agent,
+            recorder=self.recorder)
         logger.info("PlansClient %s", self.client.headers)
         if self.config['plan_fast_client']:
             fast_params = dict(params)
             fast_params['descending'] = 1
-            self.fast_client = TendersClient(
+            self.fast_client = self.client_class(
                 key=self.config['plan_api_key'],
                 host_url=self.config['plan_api_url'],
                 api_version=self.config['plan_api_version'],
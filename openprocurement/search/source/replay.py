@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+import os
+import zlib
+import struct
+import simplejson as json
+from time import time, sleep
+from bisect import bisect_left
+from functools import partial
+from munch import munchify
+
+from openprocurement.search.source.ocds import OcdsSource
+
+from logging import getLogger
+logger = getLogger(__name__)
+
+
+class CorpusFile(object):
+    """Corpus of recorded feed pages and documents
+
+    File is a magic line followed by records, each record is
+        header (kind, payload length, timestamp, key length)
+        key (resource for pages, resource/id/dateModified for docs)
+        zlib compressed json payload
+    Keys are stored uncompressed, so file can be indexed without unpacking.
+    """
+    MAGIC = 'OPSEARCH-CORPUS-1\n'
+    HEADER = struct.Struct('>cIdH')
+    KIND_PAGE = 'P'
+    KIND_DOC = 'D'
+
+
+class CorpusWriter(CorpusFile):
+    """Append-only corpus writer, safe to share between forked processes
+    """
+    def __init__(self, filename, compress_level=6):
+        self.filename = filename
+        self.compress_level = compress_level
+        self.fd = os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0644)
+        if os.fstat(self.fd).st_size == 0:
+            os.write(self.fd, self.MAGIC)
+        self.records = 0
+
+    def __del__(self):
+        self.close()
+
+    def close(self):
+        if getattr(self, 'fd', None):
+            os.close(self.fd)
+            self.fd = None
+
+    def put(self, kind, key, data):
+        if not self.fd:
+            return
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        payload = json.dumps(data, separators=(',', ':'))
+        if isinstance(payload, unicode):
+            payload = payload.encode('utf-8')
+        payload = zlib.compress(payload, self.compress_level)
+        header = self.HEADER.pack(kind, len(payload), time(), len(key))
+        # single write for O_APPEND keeps records whole
+        os.write(self.fd, header + key + payload)
+        self.records += 1
+
+    def put_page(self, resource, items):
+        self.put(self.KIND_PAGE, resource, items)
+
+    def put_doc(self, resource, doc):
+        data = doc['data']
+        key = "%s/%s/%s" % (resource, data['id'], data['dateModified'])
+        self.put(self.KIND_DOC, key, doc)
+
+
+class CorpusReader(CorpusFile):
+    """Random access corpus reader, builds index of pages and docs from headers
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.fp = open(filename, 'rb')
+        if self.fp.read(len(self.MAGIC)) != self.MAGIC:
+            raise ValueError("%s is not a corpus file" % filename)
+        self.pages = dict()
+        self.docs = dict()
+        self.cursor = dict()
+        self.listed = dict()
+        self.build_index()
+
+    def build_index(self):
+        header_size = self.HEADER.size
+        while True:
+            header = self.fp.read(header_size)
+            if len(header) < header_size:
+                break
+            kind, length, timestamp, key_len = self.HEADER.unpack(header)
+            key = self.fp.read(key_len)
+            offset = self.fp.tell()
+            if kind == self.KIND_PAGE:
+                self.pages.setdefault(key, []).append((timestamp, offset, length))
+            elif kind == self.KIND_DOC:
+                resource, doc_id, modified = key.split('/', 2)
+                versions = self.docs.setdefault(resource, {}).setdefault(doc_id, [])
+                versions.append((modified, offset, length))
+            self.fp.seek(offset + length)
+        for resource in self.docs.values():
+            for versions in resource.values():
+                versions.sort()
+        logger.info("Corpus %s has %d pages, %d docs", self.filename,
+                    sum(map(len, self.pages.values())),
+                    sum(map(len, self.docs.values())))
+
+    def load(self, offset, length):
+        self.fp.seek(offset)
+        return json.loads(zlib.decompress(self.fp.read(length)))
+
+    def next_page(self, resource):
+        """returns (timestamp, items) or (None, []) at the end of corpus"""
+        pages = self.pages.get(resource, [])
+        pos = self.cursor.get(resource, 0)
+        if pos >= len(pages):
+            return None, []
+        self.cursor[resource] = pos + 1
+        timestamp, offset, length = pages[pos]
+        items = self.load(offset, length)
+        for item in items:
+            if 'id' in item and 'dateModified' in item:
+                self.listed[(resource, item['id'])] = item['dateModified']
+        return timestamp, items
+
+    def has_doc(self, resource, doc_id, modified=None):
+        """doc is recorded, and has version not older than modified"""
+        versions = self.docs.get(resource, {}).get(doc_id)
+        if not versions:
+            return False
+        return not modified or versions[-1][0] >= modified
+
+    def get_doc(self, resource, doc_id, modified=None):
+        """returns first recorded version not older than modified,
+        by default not older than last listed in feed"""
+        versions = self.docs[resource][doc_id]
+        if modified is None:
+            modified = self.listed.get((resource, doc_id), '')
+        pos = bisect_left(versions, (modified,))
+        if pos >= len(versions):
+            pos = len(versions) - 1
+        modified, offset, length = versions[pos]
+        return self.load(offset, length)
+
+
+class ReplayClient(object):
+    """TendersClient compatible client served from corpus
+
+    Feed pages are returned in recorded order keeping recorded intervals
+    divided by speed (speed=0 means no delays). Cursor is kept in reader,
+    so source reset doesn't rewind the replay.
+    """
+    def __init__(self, key='', host_url='', api_version='0', resource='tenders',
+                 params=None, timeout=None, user_agent=None, recorder=None,
+                 reader=None, speed=1.0):
+        self.resource = resource
+        self.prefix_path = '/replay/%s' % resource
+        self.params = params or {}
+        self.headers = {'User-Agent': user_agent or ''}
+        self.reader = reader
+        self.speed = float(speed or 0)
+
+    def wait_for(self, timestamp):
+        if not self.speed or timestamp is None:
+            return
+        clock = getattr(self.reader, 'clock', None)
+        if not clock:
+            clock = self.reader.clock = (time(), timestamp)
+        delay = clock[0] + (timestamp - clock[1]) / self.speed - time()
+        if delay > 0:
+            sleep(delay)
+
+    def get_tenders(self, params={}, feed='changes'):
+        timestamp, items = self.reader.next_page(self.resource)
+        self.wait_for(timestamp)
+        return munchify(items)
+
+    def get_tender(self, tender_id):
+        return munchify(self.reader.get_doc(self.resource, tender_id))
+
+
+def replay_source(source_class, corpus, speed=1.0):
+    """Create replay class for API source, corpus is filename or CorpusReader"""
+    if not isinstance(corpus, CorpusReader):
+        corpus = CorpusReader(corpus)
+
+    class ReplaySource(source_class):
+        __doc__ = "%s replayed from corpus" % source_class.__name__
+        client_class = partial(ReplayClient, reader=corpus, speed=speed)
+
+        def __init__(self, config={}, use_cache=False):
+            config = dict(config)
+            for key in config.keys():
+                if key.endswith('_fast_client') or key.endswith('_record'):
+                    config[key] = ''
+            source_class.__init__(self, config, use_cache=False)
+
+        def items(self):
+            # original run could skip already indexed docs or not get the
+            # listed version, skip them too (source.get would wait for it)
+            for item in source_class.items(self):
+                if corpus.has_doc(self.client.resource, item['id'], item.get('dateModified')):
+                    yield item
+                else:
+                    self.stat_skipped += 1
+
+    ReplaySource.__name__ = 'Replay' + source_class.__name__
+    return ReplaySource
+
+
+class ReplayOcdsSource(OcdsSource):
+    """OCDS Source replayed from corpus, each page is one recorded file
+    """
+    def __init__(self, config={}, corpus=None, speed=1.0):
+        config = dict(config)
+        config['ocds_record'] = ''
+        OcdsSource.__init__(self, config)
+        if not isinstance(corpus, CorpusReader):
+            corpus = CorpusReader(corpus)
+        self.client = ReplayClient(resource=self.__doc_type__, reader=corpus, speed=speed)
+
+    def reset(self):
+        self.stat_resets += 1
+        self.last_reset_time = time()
+        self.should_reset = False
+
+    def items(self):
+        self.last_skipped = None
+        for item in self.client.get_tenders():
+            if self.should_exit:
+                raise StopIteration()
+            yield self.patch_version(item)
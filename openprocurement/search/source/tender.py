@@ -5,7 +5,7 @@ from datetime import datetime, timedelta
 from socket import setdefaulttimeout
 from retrying import retry
 
-from openprocurement.search.source import BaseSource, TendersClient
+from openprocurement.search.source import BaseSource
 from openprocurement.search.source.orgs import OrgsDecoder
 from openprocurement.search.utils import restkit_error
 
@@ -17,6 +17,8 @@ class TenderSource(BaseSource):
     """Tenders Source from open openprocurement.API
     """
     __doc_type__ = 'tender'
+    # lower bound of skip_until set by partitioned TenderIndex
+    min_skip_until = None
 
     config = {
         'tender_api_key': '',
@@ -36,6 +38,7 @@ class TenderSource(BaseSource):
         'tender_file_cache': '',
         'tender_cache_allow': 'complete,cancelled,unsuccessful',
         'tender_cache_minage': 15,
+        'tender_record': '',
         'timeout': 30,
     }
 
@@ -47,6 +50,8 @@ class TenderSource(BaseSource):
         self.config['tender_reseteach'] = int(self.config['tender_reseteach'] or 3)
         self.config['tender_resethour'] = int(self.config['tender_resethour'] or 0)
         self.client_user_agent += " (tenders) " + self.config['tender_user_agent']
+        if self.config['tender_record']:
+            self.record_setpath(self.config['tender_record'])
         if use_cache:
             self.cache_setpath(self.config['tender_file_cache'], self.config['tender_api_url'],
                 self.config['tender_api_version'], 'tenders')
@@ -124,18 +129,19 @@ class TenderSource(BaseSource):
             params['mode'] = self.config['tender_api_mode']
         if self.config['tender_limit']:
             params['limit'] = self.config['tender_limit']
-        self.client = TendersClient(
+        self.client = self.client_class(
             key=self.config['tender_api_key'],
             host_url=self.config['tender_api_url'],
             api_version=self.config['tender_api_version'],
             params=params,
             timeout=float(self.config['timeout']),
-            user_agent=self.client_user_agent)
+            user_agent=self.client_user_agent,
+            recorder=self.recorder)
         logger.info("TendersClient %s", self.client.headers)
         if self.config['tender_fast_client']:
             fast_params = dict(params)
             fast_params['descending'] = 1
-            self.fast_client = TendersClient(
+            self.fast_client = self.client_class(
                 key=self.config['tender_api_key'],
                 host_url=self.config['tender_api_url'],
                 api_version=self.config['tender_api_version'],
@@ -157,6 +163,8 @@ class TenderSource(BaseSource):
         self.skip_until = self.config.get('tender_skip_until', None)
         if self.skip_until and self.skip_until[:2] != '20':
             self.skip_until = None
+        if self.min_skip_until and (not self.skip_until or self.skip_until < self.min_skip_until):
+            self.skip_until = self.min_skip_until
         self.skip_after = self.config.get('tender_skip_after', None)
         if self.skip_after and self.skip_after[:2] != '20':
             self.skip_after = None
@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+import os
+import re
+import zlib
+import hashlib
+from array import array
+from bisect import bisect_left
+from itertools import islice
+from threading import Thread, Lock
+from time import time, sleep
+import simplejson as json
+
+from logging import getLogger
+logger = getLogger(__name__)
+
+TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+
+def normalize_tokens(text):
+    return TOKEN_RE.findall(text.lower())
+
+
+class OrgsPrefixIndex(object):
+    """In-memory prefix index of orgs names and codes
+
+    Orgs are numbered in rank order (lower number is higher rank), sorted
+    list of unique tokens keeps their postings in one array, so prefix is
+    a range of tokens found by bisect. For short prefixes (up to TOP_PREFIX
+    chars), which match too many tokens, numbers of TOP_SIZE best orgs and
+    count of matched orgs are kept.
+    Index is never changed after build, reload builds new one.
+    """
+    TOP_PREFIX = 3
+    TOP_SIZE = 100
+    MAX_POSTINGS = 50000
+
+    def __init__(self, docs, complete=True):
+        self.complete = complete
+        self.items = list()
+        self.names = list()
+        self.top = dict()
+        self.counts = dict()
+        postings = dict()
+        for n, doc in enumerate(docs):
+            self.items.append(json.RawJSON(json.dumps(doc, separators=(',', ':'))))
+            tokens = set(normalize_tokens(doc.get('name') or u''))
+            tokens.update(normalize_tokens(doc.get('short') or u''))
+            if doc.get('edrpou'):
+                tokens.add(unicode(doc['edrpou']).lower())
+            self.names.append(u' %s ' % u' '.join(sorted(tokens)))
+            prefixes = set()
+            for token in tokens:
+                postings.setdefault(token, array('i')).append(n)
+                for k in range(1, min(len(token), self.TOP_PREFIX) + 1):
+                    prefixes.add(token[:k])
+            for prefix in prefixes:
+                self.counts[prefix] = self.counts.get(prefix, 0) + 1
+                top = self.top.get(prefix)
+                if top is None:
+                    self.top[prefix] = array('i', [n])
+                elif len(top) < self.TOP_SIZE:
+                    top.append(n)
+            # let other greenlets run while index is built
+            if n % 1000 == 999:
+                sleep(0)
+        self.tokens = sorted(postings)
+        self.offsets = array('i')
+        self.postings = array('i')
+        for token in self.tokens:
+            self.offsets.append(len(self.postings))
+            self.postings.extend(postings[token])
+        self.offsets.append(len(self.postings))
+
+    def __len__(self):
+        return len(self.items)
+
+    def prefix_postings(self, prefix):
+        """sorted numbers of orgs having token with prefix, None if too many"""
+        lo = bisect_left(self.tokens, prefix)
+        hi = bisect_left(self.tokens, prefix + u'\uffff', lo)
+        start, end = self.offsets[lo], self.offsets[hi]
+        if end - start > self.MAX_POSTINGS:
+            return None
+        return sorted(set(self.postings[start:end]))
+
+    def search(self, query, limit=10):
+        """returns result as of search engine or None if can't answer
+        (nothing found, query too broad or index not complete)"""
+        words = sorted(set(normalize_tokens(query)), key=len, reverse=True)
+        if not words:
+            return None
+        first = words[0]
+        if len(first) <= self.TOP_PREFIX:
+            found = self.top.get(first, ())
+            total = self.counts.get(first, 0)
+            # top is not enough to filter by other words
+            if len(words) > 1 and total > len(found):
+                return None
+        else:
+            found = self.prefix_postings(first)
+            if found is None:
+                return None
+            total = len(found)
+        if len(words) > 1:
+            others = [u' ' + w for w in words[1:]]
+            found = [n for n in found if all(w in self.names[n] for w in others)]
+            total = len(found)
+        if not found or len(found) < limit and not self.complete:
+            return None
+        return {
+            'items': [self.items[n] for n in found[:limit]],
+            'total': total,
+            'start': 0,
+        }
+
+
+class TopOrgs(object):
+    """Top orgs by rank snapshot written by update_orgs, file is reloaded
+    when changed, rendered responses are kept for each limit and format
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.stat = None
+        self.data = None
+        self.rendered = dict()
+
+    def read(self):
+        try:
+            st = os.stat(self.filename)
+        except OSError:
+            return self.data
+        st_key = (st.st_ino, st.st_mtime, st.st_size)
+        if st_key != self.stat:
+            try:
+                with open(self.filename) as fp:
+                    data = json.load(fp)
+            except (IOError, ValueError) as e:
+                logger.error("Can't read %s: %s", self.filename, str(e))
+                return self.data
+            self.data = data
+            self.stat = st_key
+            self.rendered = dict()
+        return self.data
+
+    def render(self, limit, plain=False, compress=False):
+        """returns (body, etag) of toporgs response or None if snapshot
+        is missing or has less than limit orgs"""
+        data = self.read()
+        if not data:
+            return None
+        if limit > len(data['items']) and len(data['items']) < data['total']:
+            return None
+        key = (limit, plain, compress)
+        rendered = self.rendered.get(key)
+        if rendered is None:
+            items = data['items'][:limit]
+            if plain:
+                res = dict((i['edrpou'], i['name']) for i in items)
+            else:
+                res = {'items': items, 'total': data['total'], 'start': 0}
+            body = json.dumps(res, separators=(',', ':'))
+            etag = "%s|%d|%d" % (data['version'], limit, int(plain))
+            etag = hashlib.md5(etag).hexdigest()
+            if compress:
+                encoder = zlib.compressobj(9, zlib.DEFLATED, 31)
+                body = encoder.compress(body) + encoder.flush()
+                etag += '-gz'
+            rendered = self.rendered[key] = (body, etag)
+        return rendered
+
+
+class OrgsSuggest(object):
+    """Keeps OrgsPrefixIndex of current orgs index, index is reloaded in
+    background thread when orgs index is switched or updated (but not
+    often than reload_interval)
+    """
+    RETRY_WAIT = 60
+
+    def __init__(self, engine, max_orgs=100000, reload_interval=3600, index_set='orgs'):
+        self.engine = engine
+        self.max_orgs = max_orgs
+        self.reload_interval = reload_interval
+        self.index_set = index_set
+        self.index = None
+        self.index_key = None
+        self.loaded_names = None
+        self.loaded_time = 0
+        self.failed_time = 0
+        self.loading = False
+        self.lock = Lock()
+
+    def get(self):
+        """returns current prefix index (or None), starts reload if needed"""
+        names = self.engine.index_set_current(self.index_set)
+        if not names or self.loading:
+            return self.index
+        key = (names, self.engine.index_generation(names))
+        if key == self.index_key or time() - self.failed_time < self.RETRY_WAIT:
+            return self.index
+        if names != self.loaded_names or time() - self.loaded_time > self.reload_interval:
+            self.start_reload(key)
+        return self.index
+
+    def start_reload(self, key):
+        with self.lock:
+            if self.loading:
+                return
+            self.loading = True
+        thread = Thread(target=self.reload, args=(key,))
+        thread.daemon = True
+        thread.start()
+
+    def reload(self, key):
+        try:
+            start = time()
+            names = key[0]
+            body = {
+                'query': {'match_all': {}},
+                'sort': [{'rank': {'order': 'desc'}}],
+            }
+            total, hits = self.engine.scan(body, index=names, size=1000)
+            try:
+                docs = list(islice(hits, self.max_orgs))
+            finally:
+                hits.close()
+            index = OrgsPrefixIndex(docs, complete=total <= self.max_orgs)
+            self.index = index
+            self.index_key = key
+            self.loaded_names = names
+            self.loaded_time = time()
+            logger.info("Loaded %d of %d orgs from %s in %1.1f sec", len(index),
+                        total, names, time() - start)
+        except Exception as e:
+            logger.error("Can't load orgs suggest from %s: %s", key[0], str(e))
+            self.failed_time = time()
+        finally:
+            self.loading = False
+
+    def stats(self):
+        return {
+            'orgs': len(self.index) if self.index is not None else 0,
+            'complete': self.index.complete if self.index is not None else False,
+            'index': self.index_key and self.index_key[0],
+            'loaded': int(self.loaded_time),
+        }
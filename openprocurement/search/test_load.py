@@ -1,46 +1,157 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
+from gevent import monkey
+monkey.patch_all()
+
+import re
 import sys
+import gzip
+import math
+import calendar
 import argparse
 import logging
 import simplejson as json
 import urllib
 import urllib2
+import gevent
+import gevent.pool
 from datetime import datetime, timedelta
-from random import choice, randint
-from multiprocessing import Process
+from urlparse import urlsplit
+from random import choice, randint, expovariate
 from time import time
 
 g_dict = {}
-g_ordr = {}
 g_args = None
 logger = logging.getLogger('test_load')
-FORMAT = '%(asctime)-15s %(levelname)s %(processName)s %(message)s'
+FORMAT = '%(asctime)-15s %(levelname)s %(message)s'
+
+
+class LatencyHistogram(object):
+    """HDR-style log-linear latency histogram
+
+    Values are microseconds, values below `sub_buckets` are exact, each
+    next power of 2 is split into sub_buckets/2 linear buckets, so relative
+    error is less than 2/sub_buckets (1/64 by default) with fixed memory
+    regardless of number of samples.
+    """
+    def __init__(self, sub_buckets=128):
+        self.sub_buckets = sub_buckets
+        self.sub_bits = int(math.log(sub_buckets, 2))
+        self.counts = dict()
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = 0
+
+    def bucket(self, value):
+        if value < self.sub_buckets:
+            return value
+        magnitude = value.bit_length() - self.sub_bits
+        return (magnitude << self.sub_bits) + (value >> magnitude)
+
+    def bucket_value(self, bucket):
+        """highest value in bucket"""
+        if bucket < self.sub_buckets:
+            return bucket
+        magnitude = (bucket >> self.sub_bits)
+        sub = bucket - (magnitude << self.sub_bits)
+        return ((sub + 1) << magnitude) - 1
+
+    def record(self, seconds):
+        value = max(int(seconds * 1e6), 0)
+        bucket = self.bucket(value)
+        self.counts[bucket] = self.counts.get(bucket, 0) + 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        for bucket, count in other.counts.items():
+            self.counts[bucket] = self.counts.get(bucket, 0) + count
+        self.count += other.count
+        self.total += other.total
+        if other.min is not None and (self.min is None or other.min < self.min):
+            self.min = other.min
+        self.max = max(self.max, other.max)
+
+    def percentile(self, q):
+        if not self.count:
+            return 0
+        rank = max(int(math.ceil(q / 100.0 * self.count)), 1)
+        seen = 0
+        for bucket in sorted(self.counts):
+            seen += self.counts[bucket]
+            if seen >= rank:
+                return min(self.bucket_value(bucket), self.max)
+        return self.max
+
+    def as_dict(self):
+        ms = lambda v: round(v / 1000.0, 3)
+        data = {'count': self.count}
+        if self.count:
+            data.update({
+                'min': ms(self.min),
+                'mean': ms(1.0 * self.total / self.count),
+                'p50': ms(self.percentile(50)),
+                'p90': ms(self.percentile(90)),
+                'p99': ms(self.percentile(99)),
+                'p999': ms(self.percentile(99.9)),
+                'max': ms(self.max),
+            })
+        return data
 
 
-def worker():
-    logger.debug('Starting process')
+class QueryStats(object):
+    def __init__(self):
+        self.latency = LatencyHistogram()
+        self.service = LatencyHistogram()
+        self.errors = 0
+        self.notfound = 0
 
-    base_url = g_args.api_url[0]
-    if base_url.find('/') < 0:
-        base_url = '127.0.0.1:8484/' + base_url
-    if base_url.find('://') < 0:
-        base_url = 'http://' + base_url
-    plan_mode = base_url.endswith('plans')
-    auction_mode = base_url.find('auctions') + 1
+    def as_dict(self):
+        return {
+            'latency_ms': self.latency.as_dict(),
+            'service_ms': self.service.as_dict(),
+            'errors': self.errors,
+            'not_found': self.notfound,
+        }
 
-    max_errs = g_args.e
-    max_notf = g_args.z
-    max_reqs = g_args.n
 
-    requests = 0
-    n_errors = 0
-    n_notfnd = 0
+class LoadTest(object):
+    """Issue search queries from dictionaries and record latency per query type
 
-    start_time = time()
+    In open-loop mode (rate > 0) requests are scheduled at the target arrival
+    rate regardless of responses, latency is measured from the scheduled time,
+    so server stalls are not hidden by a waiting client (coordinated omission).
+    Service time is measured from the actual send time for comparison.
+    In closed-loop mode (rate = 0) each of `c` clients waits for response
+    before the next request, like the old multiprocess test_load.
+    """
+    def __init__(self, args, qdict):
+        self.args = args
+        self.qdict = qdict
+        self.base_url = args.api_url[0]
+        if self.base_url.find('/') < 0:
+            self.base_url = '127.0.0.1:8484/' + self.base_url
+        if self.base_url.find('://') < 0:
+            self.base_url = 'http://' + self.base_url
+        self.plan_mode = self.base_url.endswith('plans')
+        self.auction_mode = self.base_url.find('auctions') + 1
+        self.stats = dict()
+        self.requests = 0
+        self.dropped = 0
+        self.n_errors = 0
+        self.n_notfnd = 0
+        self.stop_reason = None
+        self.measure_from = time()
+        self.measured_time = 0
 
-    while requests < max_reqs:
-        requests += 1
+    def make_query(self):
+        """returns (query_type, url, with_sort)"""
+        g_dict = self.qdict
         key = choice(g_dict.keys())
         sort = ''
         order = ''
@@ -55,17 +166,19 @@ def worker():
             query = g_dict[key][code]
             query = query.encode('utf-8')
             args.append((key, query))
+            qtype = key
         elif key in ('cav', 'cpv', 'cpvs', 'dkpp'):
             code = choice(g_dict[key].keys())
             like = {'dkpp': 5, 'cpv': 6, 'cav': 4, 'cpvs': 4}.get(key, 6)
-            if auction_mode:
+            if self.auction_mode:
                 like = 4
             if len(code) > like:
                 code = code[:like]
-            if plan_mode:
+            if self.plan_mode:
                 key = 'plan_' + key
             key += '_like'
             args.append((key, code))
+            qtype = key
         elif key == 'date':
             subkey = choice(g_dict[key].keys())
             start = datetime.now() - timedelta(days=randint(10, 60))
@@ -74,60 +187,299 @@ def worker():
             end = end.isoformat()[:10]
             args.append((subkey + '_start', start))
             args.append((subkey + '_end', end))
+            qtype = 'date'
         elif key == 'tid' or key == 'pid' or key == 'aid':
             code = choice(g_dict[key].keys())
             key += '_like'
             args.append((key, code))
+            qtype = key
         else:
             code = choice(g_dict[key].keys())
             args.append((key, code))
+            qtype = key
         if sort:
             args.append(('sort', sort))
         if sort and order:
             args.append(('order', order))
         qs = urllib.urlencode(args, True)
-        if '?' in base_url:
-            url = base_url + '&' + qs
+        if '?' in self.base_url:
+            url = self.base_url + '&' + qs
         else:
-            url = base_url + '?' + qs
+            url = self.base_url + '?' + qs
+        return qtype, url, bool(sort)
+
+    def get_stats(self, qtype):
+        if qtype not in self.stats:
+            self.stats[qtype] = QueryStats()
+        return self.stats[qtype]
+
+    def request(self, scheduled, measure, query=None):
+        if query:
+            qtype, url, with_sort, expect = query
+        else:
+            qtype, url, with_sort = self.make_query()
+            expect = 200
+        self.requests += 1
+        sent = time()
         code = 0
         resp = ''
+        error = False
+        notfound = False
         try:
-            req = urllib2.urlopen(url, timeout=g_args.t)
+            try:
+                req = urllib2.urlopen(url, timeout=self.args.t)
+            except urllib2.HTTPError as e:
+                req = e
             code = req.getcode()
             resp = req.read()
             if not resp:
                 resp = ''
-            if code != 200:
+            if code != expect:
                 raise ValueError("BAD RESPONSE")
+            if code != 200:
+                return self.record(qtype, with_sort, scheduled, sent, measure, False, False)
             data = json.loads(resp)
             items = data.get('items')
             total = data.get('total')
-            error = data.get('error')
-            if error:
-                raise ValueError(error)
+            if data.get('error'):
+                raise ValueError(data['error'])
             if not items or not total:
-                n_notfnd += 1
+                notfound = True
             logger.debug("%d %d %s total %d", code, len(resp), url, total)
         except Exception as e:
             logger.error("%d %d %s error %s", code, len(resp), url, str(e))
-            n_errors += 1
-        if n_notfnd >= max_notf:
-            logger.error('Exit by max_not_found reached (%d requests, %d not found)',
-                requests, n_notfnd)
-            sys.exit(1)
+            error = True
+        self.record(qtype, with_sort, scheduled, sent, measure, error, notfound)
+
+    def record(self, qtype, with_sort, scheduled, sent, measure, error, notfound):
+        done = time()
+        if error:
+            self.n_errors += 1
+        elif notfound:
+            self.n_notfnd += 1
+        if not measure:
             return
-        if n_errors >= max_errs:
-            logger.error('Exit by max error occurred (%d requests, %d errors)',
-                requests, n_errors)
-            sys.exit(2)
+        types = ['all', qtype, 'sort'] if with_sort else ['all', qtype]
+        for name in types:
+            stats = self.get_stats(name)
+            if error:
+                stats.errors += 1
+                continue
+            if notfound:
+                stats.notfound += 1
+            stats.latency.record(done - scheduled)
+            stats.service.record(done - sent)
+        self.check_limits()
+
+    def check_limits(self):
+        if self.stop_reason:
             return
+        if self.n_notfnd >= self.args.z and not self.args.replay:
+            self.stop_reason = 'max_not_found'
+        elif self.n_errors >= self.args.e:
+            self.stop_reason = 'max_errors'
+        if self.stop_reason:
+            logger.error('Exit by %s reached (%d requests, %d not found, %d errors)',
+                self.stop_reason, self.requests, self.n_notfnd, self.n_errors)
+
+    def arrivals(self):
+        """yields (offset_seconds, query) for synthetic open loop"""
+        offset = 0
+        while True:
+            yield offset, None
+            if self.args.poisson:
+                offset += expovariate(self.args.rate)
+            else:
+                offset += 1.0 / self.args.rate
 
-    total_time = time() - start_time
-    query_rate = 1.0 * requests / total_time
+    def replay_arrivals(self):
+        """yields (offset_seconds, query) from access logs scaled by speed"""
+        parts = urlsplit(self.base_url)
+        base_url = '%s://%s' % (parts.scheme, parts.netloc)
+        schedule = list()
+        for filename in self.args.replay:
+            schedule.extend(read_access_log(filename))
+        # restored arrivals of slow requests precede earlier logged ones
+        schedule.sort()
+        first = schedule[0][0] if schedule else 0
+        for timestamp, path, status in schedule:
+            endpoint = path.split('?', 1)[0]
+            query = (endpoint, base_url + path, False, status)
+            yield (timestamp - first) / self.args.speed, query
 
-    logger.info('Leaving process, %d requests, %d not found, %d errors, %1.1f r/s',
-                requests, n_notfnd, n_errors, query_rate)
+    def run_open_loop(self, schedule):
+        args = self.args
+        pool = gevent.pool.Pool(args.max_inflight)
+        start_time = time()
+        measure_from = self.measure_from = start_time + args.warmup
+        stop_time = measure_from + args.duration if args.duration else None
+        for offset, query in schedule:
+            scheduled = start_time + offset
+            if stop_time and scheduled >= stop_time or self.stop_reason:
+                break
+            delay = scheduled - time()
+            if delay > 0:
+                gevent.sleep(delay)
+            if pool.full():
+                # don't wait for free slot, it would shift schedule
+                self.dropped += 1
+                if scheduled >= measure_from:
+                    self.get_stats('all').errors += 1
+                    self.n_errors += 1
+                    self.check_limits()
+            else:
+                pool.spawn(self.request, scheduled, scheduled >= measure_from, query)
+        pool.join(timeout=args.t + 1)
+        pool.kill()
+
+    def run_closed_loop(self):
+        args = self.args
+        start_time = time()
+        measure_from = self.measure_from = start_time + args.warmup
+        stop_time = measure_from + args.duration if args.duration else None
+
+        def client():
+            for i in xrange(args.n):
+                if self.stop_reason:
+                    break
+                now = time()
+                if stop_time and now >= stop_time:
+                    break
+                self.request(now, now >= measure_from)
+
+        clients = [gevent.spawn(client) for i in range(args.c)]
+        try:
+            gevent.joinall(clients, raise_error=True)
+        finally:
+            gevent.killall(clients)
+
+    def run(self):
+        try:
+            if self.args.replay:
+                logger.info('Replay %s at %1.1fx speed', ', '.join(self.args.replay),
+                    self.args.speed)
+                self.run_open_loop(self.replay_arrivals())
+            elif self.args.rate:
+                logger.info('Open loop %1.1f r/s for %1.1f sec after %1.1f sec warmup',
+                    self.args.rate, self.args.duration, self.args.warmup)
+                self.run_open_loop(self.arrivals())
+            else:
+                logger.info('Closed loop %d clients x %d requests', self.args.c, self.args.n)
+                self.run_closed_loop()
+        finally:
+            self.measured_time = max(time() - self.measure_from, 0)
+
+    def report(self):
+        measured = self.get_stats('all')
+        count = measured.latency.count + measured.errors
+        data = {
+            'url': self.base_url,
+            'mode': 'replay' if self.args.replay else 'open' if self.args.rate else 'closed',
+            'speed': self.args.speed if self.args.replay else None,
+            'target_rate': self.args.rate,
+            'concurrency': self.args.max_inflight if self.args.rate or self.args.replay
+                else self.args.c,
+            'warmup': self.args.warmup,
+            'duration': round(self.measured_time, 3),
+            'requests': self.requests,
+            'measured': count,
+            'achieved_rate': round(count / self.measured_time, 3) if self.measured_time > 0 else 0,
+            'dropped': self.dropped,
+            'stop_reason': self.stop_reason,
+            'types': dict((k, v.as_dict()) for k, v in self.stats.items()),
+        }
+        for name in sorted(self.stats):
+            latency = self.stats[name].latency.as_dict()
+            logger.info('%-16s %6d req p50 %8.1f p90 %8.1f p99 %8.1f p999 %8.1f max %8.1f ms',
+                name, latency['count'], latency.get('p50', 0), latency.get('p90', 0),
+                latency.get('p99', 0), latency.get('p999', 0), latency.get('max', 0))
+        logger.info('Total %d requests in %1.3f sec %1.1f r/s, %d errors, %d not found',
+            count, self.measured_time, data['achieved_rate'], measured.errors,
+            measured.notfound)
+        if self.args.baseline:
+            data['baseline'] = compare_baseline(load_json(self.args.baseline), data)
+        if self.args.o:
+            with open(self.args.o, 'w') as fp:
+                json.dump(data, fp, sort_keys=True, indent=2)
+        return data
+
+
+# gunicorn access_log_format from accesslog.conf, see docs/settings.md
+# '%(h)s %(l)s %(u)s %(t)s "%(r)s" %(s)s %(b)s "%(f)s" "%(a)s" %(L)s'
+ACCESS_LOG_RE = re.compile(r'^\S+ \S+ \S+ \[(?P<time>[^\]]+)\] "(?P<request>[^"]*)" '
+                           r'(?P<status>\d+) \S+ "[^"]*" "[^"]*" (?P<elapsed>[\d.]+)')
+
+
+def read_access_log(filename):
+    """yields (timestamp, path, status) for GET requests, not sorted
+
+    gunicorn logs request when response is done with 1 second resolution,
+    so arrival time is restored as log time minus request time and requests
+    logged in the same second are spread evenly over that second.
+    """
+    opener = gzip.open if filename.endswith('.gz') else open
+    skipped = 0
+    group = list()
+    group_time = None
+    with opener(filename) as fp:
+        for line in fp:
+            m = ACCESS_LOG_RE.match(line)
+            if not m:
+                skipped += 1
+                continue
+            request = m.group('request').split(' ')
+            if len(request) < 2 or request[0] != 'GET':
+                skipped += 1
+                continue
+            timestamp = calendar.timegm(datetime.strptime(
+                m.group('time')[:20], '%d/%b/%Y:%H:%M:%S').timetuple())
+            if timestamp != group_time:
+                for item in spread_group(group, group_time):
+                    yield item
+                group = list()
+                group_time = timestamp
+            group.append((float(m.group('elapsed')), request[1], int(m.group('status'))))
+    for item in spread_group(group, group_time):
+        yield item
+    if skipped:
+        logger.info('Skipped %d not GET or unparsed lines in %s', skipped, filename)
+
+
+def spread_group(group, group_time):
+    arrivals = list()
+    for i, (elapsed, path, status) in enumerate(group):
+        arrivals.append((group_time + 1.0 * i / len(group) - elapsed, path, status))
+    return arrivals
+
+
+def compare_baseline(baseline, current):
+    """per query type (endpoint) latency and error deltas against baseline run"""
+    def error_rate(stats):
+        total = stats['latency_ms']['count'] + stats['errors']
+        return 100.0 * stats['errors'] / total if total else 0.0
+
+    deltas = dict()
+    base_types = baseline.get('types', {})
+    for name in sorted(current['types']):
+        if name not in base_types:
+            continue
+        base = base_types[name]
+        curr = current['types'][name]
+        delta = {}
+        for key in ('p50', 'p90', 'p99', 'p999'):
+            a = base['latency_ms'].get(key, 0)
+            b = curr['latency_ms'].get(key, 0)
+            delta[key] = round(b - a, 3)
+            delta[key + '_pct'] = round(100.0 * (b - a) / a, 1) if a else None
+        delta['error_rate'] = round(error_rate(curr) - error_rate(base), 3)
+        delta['not_found'] = curr['not_found'] - base['not_found']
+        deltas[name] = delta
+        logger.info('%-16s delta p50 %+8.1f p99 %+8.1f p999 %+8.1f ms errors %+6.2f%%',
+            name, delta['p50'], delta['p99'], delta['p999'], delta['error_rate'])
+    missing = sorted(set(base_types) - set(current['types']))
+    if missing:
+        logger.warning('Not in current run: %s', ', '.join(missing))
+    return deltas
 
 
 def load_json(filename):
@@ -141,13 +493,32 @@ def load_json(filename):
 def prepare():
     global g_args, g_dict
     parser = argparse.ArgumentParser(description='openprocurement.search.test_load')
-    parser.add_argument('-c', metavar='concurrency', type=int, default=1)
+    parser.add_argument('-c', metavar='concurrency', type=int, default=1,
+        help='closed loop clients')
     parser.add_argument('-e', metavar='max_errors', type=int, default=10)
     parser.add_argument('-z', metavar='max_not_found', type=int, default=100)
-    parser.add_argument('-n', metavar='requests', type=int, default=100)
+    parser.add_argument('-n', metavar='requests', type=int, default=100,
+        help='closed loop requests per client')
     parser.add_argument('-t', metavar='timeout', type=int, default=10)
+    parser.add_argument('-o', metavar='result.json', help='save report as json')
     parser.add_argument('-v', metavar='verbosity', help='10 = debug, 40 = error',
         type=int, default=logging.INFO)
+    parser.add_argument('--rate', type=float, default=0,
+        help='open loop arrival rate r/s (default 0 = closed loop)')
+    parser.add_argument('--poisson', action='store_true',
+        help='exponential inter-arrival times instead of fixed')
+    parser.add_argument('--duration', type=float, default=0,
+        help='measured seconds (required for open loop)')
+    parser.add_argument('--warmup', type=float, default=0,
+        help='seconds of not measured load before duration')
+    parser.add_argument('--max-inflight', type=int, default=1000,
+        help='open loop concurrent requests limit, over limit counted as errors')
+    parser.add_argument('--replay', metavar='access.log', nargs='+',
+        help='replay GET requests from gunicorn access logs (optionaly gzipped)')
+    parser.add_argument('--speed', type=float, default=1.0,
+        help='replay speed multiplier (default 1)')
+    parser.add_argument('--baseline', metavar='baseline.json',
+        help='report deltas against previous -o result')
     parser.add_argument('--log', metavar='output.log', nargs=1)
     parser.add_argument('--aid', metavar='auction_id.json', nargs=1)
     parser.add_argument('--tid', metavar='tender_id.json', nargs=1)
@@ -182,36 +553,24 @@ def prepare():
                 logger.debug('Load %s from %s', key, filename)
                 g_dict[key] = load_json(filename)
 
-    if not g_dict:
+    if not g_dict and not g_args.replay:
         raise ValueError('At least one of cpv, dkpp, edrpou or query is required')
 
+    if g_args.rate and not g_args.duration:
+        g_args.duration = g_args.n * g_args.c / g_args.rate
+
 
 def main():
     prepare()
 
-    logger.info('Starting %d workers', g_args.c)
-    process_list = list()
-    start_time = time()
-    for i in range(g_args.c):
-        p = Process(target=worker)
-        process_list.append(p)
-        p.daemon = True
-        p.start()
-
-    logger.info('Waiting for workers')
-    errors = 0
-    for p in process_list:
-        p.join()
-        if p.exitcode:
-            errors += 1
-
-    total_time = time() - start_time
-    query_rate = 1.0 * g_args.n * g_args.c / total_time
-    logger.info('Total %d x %d queries in %1.3f sec %1.1f r/s',
-        g_args.c, g_args.n, total_time, query_rate)
-
-    if errors:
-        logger.error("But %d of %d childs failed", errors, g_args.c)
+    test = LoadTest(g_args, g_dict)
+    try:
+        test.run()
+    except KeyboardInterrupt:
+        logger.info('User interrupt')
+    test.report()
+
+    if test.stop_reason:
         sys.exit(1)
 
     return 0
@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import simplejson as json
+
+# search_server reads config from *.ini in sys.argv on import
+
+test_dir = tempfile.mkdtemp(prefix='opsearch-test-')
+index_names = os.path.join(test_dir, 'index_names')
+
+with open(index_names + '.yaml', 'w') as fp:
+    json.dump({'tenders': 'tenders_1', 'plans': 'plans_1'}, fp)
+
+with open(os.path.join(test_dir, 'search.ini'), 'w') as fp:
+    fp.write("[search_engine]\n"
+             "index_names = %s\n"
+             "elastic_host = 127.0.0.1:1\n"
+             "search_coalesce = 0\n"
+             "search_etag = 1\n"
+             "search_cache_ttl = 60\n"
+             "search_export_limit = 0\n" % index_names)
+
+sys.argv.append(os.path.join(test_dir, 'search.ini'))
+
+from openprocurement.search import search_server as ss  # noqa: E402
+
+
+def tearDownModule():
+    shutil.rmtree(test_dir, ignore_errors=True)
+
+
+def write_generations(**generations):
+    filename = ss.search_engine.notify_filename()
+    with open(filename + '.tmp', 'w') as fp:
+        json.dump(dict((k, {'generation': v}) for k, v in generations.items()), fp)
+    os.rename(filename + '.tmp', filename)
+
+
+class FakeElastic(object):
+    """records search calls and returns count response"""
+    def __init__(self, total=3, aggregations=None):
+        self.total = total
+        self.aggregations = aggregations or {}
+        self.calls = list()
+
+    def search(self, index=None, body=None, **kwargs):
+        self.calls.append((index, body, kwargs))
+        return {
+            'hits': {'total': self.total, 'hits': []},
+            'aggregations': self.aggregations,
+        }
+
+
+class CursorTestCase(unittest.TestCase):
+    def test_round_trip(self):
+        sort = [{'date': {'order': 'desc', 'missing': '_last'}}]
+        for values in ([1420070400000, u'id1'], [u'значення', u'id2'],
+                       [None, u'id3'], [2 ** 63 - 1, u'id4']):
+            token = ss.encode_cursor(sort, values)
+            self.assertNotIn('=', token)
+            self.assertEqual(ss.decode_cursor(token, 'date', 'desc'), tuple(values))
+
+    def test_sort_mismatch(self):
+        token = ss.encode_cursor([{'date': {'order': 'asc'}}], [1, u'id1'])
+        self.assertRaises(ValueError, ss.decode_cursor, token, 'date', 'desc')
+        self.assertRaises(ValueError, ss.decode_cursor, token, 'value', 'asc')
+
+    def test_bad_token(self):
+        for token in ('', 'xyz', '!!!', ss.encode_cursor([{'date': {'order': 'asc'}}], [1])):
+            self.assertRaises(ValueError, ss.decode_cursor, token, 'date', 'asc')
+
+
+class SearchCacheKeyTestCase(unittest.TestCase):
+    def test_normalized_args(self):
+        with ss.search_server.test_request_context('/plans?b=2&a=1&b=1'):
+            key1, names1 = ss.search_cache_key('plans')
+        with ss.search_server.test_request_context('/plans?a=1&b=1&b=2'):
+            key2, names2 = ss.search_cache_key('plans')
+        self.assertEqual(key1, key2)
+        self.assertEqual(names1, 'plans_1')
+        self.assertIn('|plans_1', key1)
+
+    def test_etag_includes_generation(self):
+        with ss.search_server.test_request_context('/plans'):
+            key, names = ss.search_cache_key('plans')
+        self.assertNotEqual(ss.search_etag_value(key, '1'),
+                            ss.search_etag_value(key, '2'))
+
+
+class CountFacetsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.elastic = ss.search_engine.elastic
+        self.fake = ss.search_engine.elastic = FakeElastic()
+        self.client = ss.search_server.test_client()
+        ss.facets_cache.clear()
+        write_generations(plans_1=1, tenders_1=1)
+
+    def tearDown(self):
+        ss.search_engine.elastic = self.elastic
+
+    def test_count(self):
+        r = self.client.get('/plans/count?query=school')
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(json.loads(r.data), {'total': 3})
+        index, body, kwargs = self.fake.calls[0]
+        self.assertEqual(index, 'plans_1')
+        self.assertEqual(kwargs['search_type'], 'count')
+        self.assertNotIn('sort', body)
+
+    def test_count_cached_until_generation(self):
+        r1 = self.client.get('/tenders/count?status=active')
+        r2 = self.client.get('/tenders/count?status=active')
+        self.assertEqual(len(self.fake.calls), 1)
+        self.assertEqual(r1.data, r2.data)
+        self.assertEqual(r1.get_etag(), r2.get_etag())
+        r3 = self.client.get('/tenders/count?status=active',
+                             headers={'If-None-Match': r1.get_etag()[0]})
+        self.assertEqual(r3.status_code, 304)
+        # index_worker published update of tenders index
+        write_generations(plans_1=1, tenders_1=2)
+        r4 = self.client.get('/tenders/count?status=active',
+                             headers={'If-None-Match': r1.get_etag()[0]})
+        self.assertEqual(r4.status_code, 200)
+        self.assertEqual(len(self.fake.calls), 2)
+        self.assertNotEqual(r4.get_etag(), r1.get_etag())
+
+    def test_facets(self):
+        self.fake.aggregations = {
+            'status': {'buckets': [
+                {'key': 'active', 'doc_count': 2},
+                {'key': 'complete', 'doc_count': 1},
+            ]},
+            'cpv': {'buckets': {
+                '45': {'doc_count': 2},
+                '09': {'doc_count': 1},
+                '33': {'doc_count': 0},
+            }},
+        }
+        r = self.client.get('/tenders/facets?facet=status&facet=cpv')
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(json.loads(r.data), {
+            'total': 3,
+            'facets': {
+                'status': [{'key': 'active', 'count': 2},
+                           {'key': 'complete', 'count': 1}],
+                'cpv': [{'key': '09', 'count': 1},
+                        {'key': '45', 'count': 2}],
+            },
+        })
+        index, body, kwargs = self.fake.calls[0]
+        self.assertEqual(sorted(body['aggs']), ['cpv', 'status'])
+        self.assertIn('filters', body['aggs']['cpv'])
+
+    def test_facets_errors(self):
+        r = self.client.get('/tenders/facets?facet=unknown')
+        self.assertIn('error', json.loads(r.data))
+        r = self.client.get('/tenders/facets?interval=century&facet=date')
+        self.assertIn('error', json.loads(r.data))
+        self.assertEqual(self.fake.calls, [])
+        # errors are not cached
+        self.client.get('/tenders/facets?facet=unknown')
+        self.assertEqual(ss.facets_cache.stats()['items'], 0)
+
+    def test_unknown_view_set(self):
+        self.assertEqual(self.client.get('/orgs/count').status_code, 404)
+        self.assertEqual(self.client.get('/export/count').status_code, 404)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -4,10 +4,14 @@ import os
 import sys
 import fcntl
 import signal
+import hashlib
+import simplejson as json
 import logging.config
 from datetime import datetime, timedelta
 
 from ConfigParser import ConfigParser
+from elasticsearch.client import IndicesClient
+from elasticsearch.exceptions import ElasticsearchException
 
 from openprocurement.search.version import __version__
 from openprocurement.search.engine import IndexEngine, logger
@@ -176,6 +180,43 @@ class IndexOrgsEngine(IndexEngine):
         logger.info("[%s] Updated %d / %d orgs %d%%",
             index_name, update_count, iter_count,
             int(100.0 * iter_count / map_len))
+        # let search servers know about new ranks, buffered updates
+        # are written first (flush_bulk publishes notify itself)
+        self.flush_bulk()
+        self.publish_notify()
+
+    def write_toporgs(self, size=1000):
+        """save top orgs by rank for orgsuggest?toporgs (see TopOrgs)"""
+        index_name = self.get_current_indexes()
+        if not index_name or self.should_exit:
+            return
+        # ranks just written must be searchable
+        self.flush_bulk()
+        try:
+            IndicesClient(self.elastic).refresh(index=index_name)
+        except ElasticsearchException as e:
+            logger.error("[%s] Can't refresh before top orgs: %s", index_name, str(e))
+        body = {
+            "query": {"match_all": {}},
+            "sort": {"rank": {"order": "desc"}},
+        }
+        res = self.search(body, limit=size, index=index_name)
+        if 'error' in res:
+            logger.error("[%s] Can't get top orgs: %s", index_name, res['error'])
+            return
+        items = json.dumps(res['items'], separators=(',', ':'))
+        data = {
+            'version': hashlib.md5(items).hexdigest(),
+            'index': index_name,
+            'total': res['total'],
+            'items': res['items'],
+        }
+        filename = self.toporgs_filename()
+        with open(filename + '.tmp', 'w') as fp:
+            json.dump(data, fp, separators=(',', ':'))
+        os.rename(filename + '.tmp', filename)
+        logger.info("[%s] Saved %d top orgs to %s", index_name,
+            len(res['items']), filename)
 
 
 def main():
@@ -234,6 +275,9 @@ def main():
             source = AuctionSource(config)
             engine.process_source(source)
         engine.flush_orgs_map()
+        toporgs_size = int(uo_config.get('toporgs_size', 1000))
+        if toporgs_size > 0:
+            engine.write_toporgs(toporgs_size)
     except Exception as e:
         logger.exception("Exception: %s", str(e))
     finally:
@@ -4,6 +4,10 @@ import fcntl
 import yaml
 import time
 import logging
+import simplejson as json
+from threading import Lock
+
+YamlLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
 
 
 def restkit_error(e, client=None):
@@ -75,12 +79,18 @@ class InfoHandler(logging.StreamHandler):
 
 class SharedFileDict(object):
     """dict shared between processes
+
+    File is written as JSON (which is also valid YAML for older readers)
+    and reparsed only when replaced (inode, mtime or size changed), so
+    expire only limits how often file is checked by stat.
     """
     def __init__(self, name, expire=1):
         self.cache = dict()
         self.filename = name + '.yaml'
         self.lastsync = 0
         self.expire = expire
+        self.stat = None
+        self.version = 0
 
     def __setitem__(self, key, value):
         if self.cache.get(key) == value:
@@ -103,6 +113,7 @@ class SharedFileDict(object):
         return self.cache.get(key, default)
 
     def pop(self, key, default=None):
+        self.version += 1
         return self.cache.pop(key, default)
 
     def update(self, items):
@@ -112,26 +123,74 @@ class SharedFileDict(object):
     def is_expired(self):
         return time.time() - self.lastsync > self.expire
 
-    def read(self):
+    def read(self, force=False):
         try:
-            with open(self.filename) as fp:
-                self.cache = yaml.load(fp) or {}
+            st = os.stat(self.filename)
+            st_key = (st.st_ino, st.st_mtime, st.st_size)
+            if force or st_key != self.stat:
+                with open(self.filename) as fp:
+                    self.cache = self.parse(fp.read())
+                self.stat = st_key
+                self.version += 1
             self.lastsync = time.time()
-        except (IOError, ValueError):
+        except (OSError, IOError, ValueError, yaml.YAMLError):
             pass
 
+    @staticmethod
+    def parse(data):
+        try:
+            return json.loads(data) or {}
+        except ValueError:
+            # files written before switch to json
+            return yaml.load(data, Loader=YamlLoader) or {}
+
     def write(self, pop_key=None, reread=True):
         tmp_file = self.filename+'.tmp'
         with open(tmp_file, 'w') as fp:
             fcntl.lockf(fp, fcntl.LOCK_EX)
             if reread:
                 tmp_cache = self.cache
-                self.read()
+                self.read(force=True)
                 self.cache.update(tmp_cache)
             if pop_key:
                 self.cache.pop(pop_key)
-            yaml.dump(self.cache, fp,
-                default_flow_style=False)
+            json.dump(self.cache, fp, sort_keys=True, indent=2)
+            fp.write('\n')
             fcntl.lockf(fp, fcntl.LOCK_UN)
         os.rename(tmp_file, self.filename)
+        self.version += 1
         # self.lastsync = time.time()
+
+
+class SharedSlots(object):
+    """limit of concurrent jobs shared by all processes on host
+
+    Each slot is a byte of lock file held with fcntl lock, locks are
+    released by OS if process dies. fcntl locks don't conflict within
+    process, so slots taken by this process are also kept in a set.
+    """
+    def __init__(self, filename, limit):
+        self.filename = filename
+        self.limit = limit
+        self.fd = os.open(filename, os.O_RDWR | os.O_CREAT, 0600)
+        self.taken = set()
+        self.lock = Lock()
+
+    def acquire(self):
+        """returns slot number or None if all slots are taken"""
+        with self.lock:
+            for slot in range(self.limit):
+                if slot in self.taken:
+                    continue
+                try:
+                    fcntl.lockf(self.fd, fcntl.LOCK_EX | fcntl.LOCK_NB, 1, slot)
+                except IOError:
+                    continue
+                self.taken.add(slot)
+                return slot
+        return None
+
+    def release(self, slot):
+        with self.lock:
+            fcntl.lockf(self.fd, fcntl.LOCK_UN, 1, slot)
+            self.taken.discard(slot)
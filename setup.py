@@ -23,6 +23,7 @@ setup(
     package_data={'': ['*.md', '*.txt', 'openprocurement/search/index/settings/*.json']},
     include_package_data=True,
     zip_safe=False,
+    test_suite='openprocurement.search.tests',
     install_requires=[
         'elasticsearch==1.9.0',
         'openprocurement_client==1.0b3',
@@ -38,6 +39,8 @@ setup(
     entry_points={
         'console_scripts': [
             'index_worker = openprocurement.search.index_worker:main',
+            'bench_index = openprocurement.search.bench_index:main',
+            'bench_search = openprocurement.search.bench_search:main',
             'search_server = openprocurement.search.search_server:main',
             'clean_indexes = openprocurement.search.clean_indexes:main',
             'ocds_ftp_sync = openprocurement.search.ocds_ftp_sync:main',